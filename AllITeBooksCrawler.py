@@ -24,6 +24,39 @@ original owner. Anyone who download any material is responsible for his behavior
 #(2) When your have download all the pages for the first time, then you might
 #    want to update your inventory and database regularly, then you should run
 #    with "AllITeBooksCrawler(updating = True)".
+#(3) The database is kept incrementally in 'allitebooks.sqlite', an existing
+#    'allitebooks.xlsx' is imported once on the first loading. Use 
+#    "AllITeBooksCrawler().export_DB()" to export the workbook on demand.
+#(4) "AllITeBooksCrawler(engine = 'asyncio', concurrency = {'download' : 4})" runs 
+#    the asyncio engine, with separate limits for listing pages, book pages and
+#    file downloads (see CONCURRENCY).
+#(5) Downloaded files are verified in a process pool after crawling, corrupt ones
+#    are moved to 'wrong_books' and downloaded again. Call 
+#    "AllITeBooksCrawler().verify_Books(recheck = True)" to verify all of them.
+#(6) Each book is stored once under 'books/.blobs' by its SHA-256, the files in
+#    'books' are hard links to them. Do not edit the files in place.
+#(7) "AllITeBooksCrawler(status_port = 8000)" serves live metrics while crawling,
+#    JSON at http://127.0.0.1:8000/ and Prometheus text at /metrics. A summary is
+#    printed and saved to 'metrics.json' when finished.
+#(8) "python benchmark.py" measures the crawler offline, against a stand-in site
+#    on localhost (see "AllITeBooksCrawler(base_url = ...)").
+#(9) The catalog is indexed for full-text search in 'allitebooks-search.sqlite',
+#    e.g. "python AllITeBooksCrawler.py search machine learning --category Python
+#    --year 2015-2017", or "CATALOG.search_index.search(...)" from Python.
+#(10) "python AllITeBooksCrawler.py worker --workers 4" crawls with 4 processes
+#    sharing 'allitebooks-work.sqlite'. Workers started on other hosts against the
+#    same directory join in, the work of a crashed worker is taken over. A finished
+#    work queue is left as it is, remove it to crawl from scratch again.
+#(11) Downloads are scheduled smallest first, see DOWNLOAD_POLICIES, e.g.
+#    "AllITeBooksCrawler(download_policy = ('pdf-first', 'newest-first'))", and
+#    "AllITeBooksCrawler(bandwidth = 2 ** 20)" keeps all downloads within 1 MB/s.
+#    The cap is per process: "worker --workers 4 --bandwidth 1024" splits 1 MB/s
+#    among the 4 workers, workers on other hosts are capped by their own hosts.
+#(12) Every page fetched is archived in 'crawl.warc.gz' (WARC records, gzipped).
+#    "python AllITeBooksCrawler.py replay" crawls it again from the archive only,
+#    and "AllITeBooksCrawler().reparse_Archive()" re-extracts the catalog from it,
+#    e.g. after a parser fix. Workers archive to '<host>-<pid>.crawl.warc.gz' each,
+#    replay them with "--archive '*.crawl.warc.gz'".
 
 # DEBUG
 #(1) When downloading to another disk, Disk C:, i.e. the System Disk, was fulfilled 
@@ -42,50 +75,291 @@ original owner. Anyone who download any material is responsible for his behavior
 #    quote the url before request.
 
 import os
+import gzip
+import glob
+import json
+import pickle
+import hashlib
+import asyncio
+import re
+import zlib
+import random
+import itertools
 import string
+import sqlite3
+import zipfile
 import socket
+import bisect
+import heapq
+import http.client
+import http.server
 import pandas
+import urllib.error
+import urllib.parse
 import urllib.request
 import html.parser
 from numpy import nan
-from shutil import rmtree
-from time import sleep, ctime
-from threading import Thread, Lock
-from queue import Queue
+from shutil import rmtree, copyfile
+from time import sleep, ctime, time, perf_counter, strftime, gmtime
+from threading import Thread, Lock, RLock, Event, Condition, current_thread, get_ident
+from queue import Queue, Empty
+from functools import lru_cache
+from collections import namedtuple, Counter
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+SLUG_TABLE = str.maketrans({char : '-' for char in string.punctuation + string.whitespace})
+DASH_RUNS = re.compile('-{2,}')
+FORMAT_CACHE_SIZE = 2 ** 14 # names kept by the LRU cache shared by FORMAT_TO_LINK / _FILENAME
+
+@lru_cache(maxsize = FORMAT_CACHE_SIZE)
+def FORMAT_NAME(s, kind):
+    # kind, 'link' or 'filename', one bounded cache for both formats
+    if kind == 'link': # every punctuation / whitespace to '-', then collapse runs of '-'
+        return DASH_RUNS.sub('-', s.translate(SLUG_TABLE)).lower()
+    return string.capwords(s.replace('-', ' '))
 
 def FORMAT_TO_LINK(s):
     # format string: "Practical PHP 7, MySQL 8" >> "practical-php-7-mysql-8"
-    for char in s:
-        if (char in string.punctuation) or (char in string.whitespace):
-            s = s.replace(char, '-')
-        for i in range(len(s)):
-            if s[i : i + 2] == '--':
-                s = s[ : i + 1] + s[i + 2 : ]
-    return s.lower()
+    return FORMAT_NAME(s, 'link')
 
 def FORMAT_TO_FILENAME(s):
     # format string: "practical-php-7-mysql-8" >> "Practical Php 7 Mysql 8"
-    s = s.replace('-', ' ')
-    return string.capwords(s)
+    return FORMAT_NAME(s, 'filename')
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 
+                   float('inf')) # upper bounds in seconds
+METRICS_FILE = 'metrics.json' # summary written at the end of each run
+
+class Histogram(object):
+    '''latencies in LATENCY_BUCKETS, with count, sum and max
+'''
+    def __init__(self, bounds = LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * len(bounds)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(self.bounds, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+
+    def quantile(self, q):
+        # upper bound of the bucket the q-quantile falls in
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def to_dict(self):
+        return {'count' : self.count, 'sum' : round(self.sum, 6), 'max' : round(self.max, 6),
+                'mean' : round(self.sum / self.count, 6) if self.count else 0.0, 
+                'p50' : self.quantile(0.5), 'p95' : self.quantile(0.95), 'p99' : self.quantile(0.99)}
+
+WORKER_COUNTERS = ('files downloaded', 'bytes downloaded', 'download seconds')
+
+class Metrics(object):
+    '''telemetry of a crawl, shared by all threads:
+histograms, seconds per stage ('listing fetch', 'bookpage fetch', 'parse', 'catalog write', 
+            'file download', 'lock wait')
+counters, (name, labels) -> number, e.g. ('retries', (('error', 'TimeoutError'), ('kind', 'file'))),
+          WORKER_COUNTERS are labelled by the worker thread, and summed up per worker
+gauges, name -> function returning the current value, e.g. the depth of a queue
+'''
+    def __init__(self):
+        self.lock = Lock() # never a TimedLock, which reports here
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started = time()
+            self.histograms = {}
+            self.counters = {}
+            self.gauges = {}
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            if stage not in self.histograms:
+                self.histograms[stage] = Histogram()
+            self.histograms[stage].observe(seconds)
+
+    @contextmanager
+    def timed(self, stage):
+        started = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, perf_counter() - started)
+
+    def count(self, name, n = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + n
+
+    def gauge(self, name, func):
+        with self.lock:
+            self.gauges[name] = func
+
+    def snapshot(self):
+        with self.lock:
+            elapsed = time() - self.started
+            histograms = {stage : histogram.to_dict() for stage, histogram in self.histograms.items()}
+            counters = dict(self.counters)
+            gauges = dict(self.gauges)
+        downloaded = sum(n for (name, labels), n in counters.items() if name == 'bytes downloaded')
+        workers = {} # worker -> {counter : number, 'bytes/s'}
+        for (name, labels), n in counters.items():
+            worker = dict(labels).get('worker')
+            if worker and name in WORKER_COUNTERS:
+                workers.setdefault(worker, dict.fromkeys(WORKER_COUNTERS, 0))[name] += n
+        for stats in workers.values():
+            seconds = stats['download seconds']
+            stats['bytes/s'] = round(stats['bytes downloaded'] / seconds, 1) if seconds else 0.0
+        values = {}
+        for name, func in gauges.items():
+            try:
+                values[name] = func()
+            except Exception: # e.g. a queue gone already
+                values[name] = None
+        return {'elapsed' : round(elapsed, 3), 
+                'bytes/s' : round(downloaded / elapsed, 1) if elapsed else 0.0,
+                'stages' : histograms, 
+                'counters' : [dict(labels, name = name, value = n) 
+                              for (name, labels), n in sorted(counters.items())],
+                'gauges' : values, 
+                'workers' : workers, 
+                'downloads' : {file : dict(progress) for file, progress in list(DOWNLOAD_PROGRESS.items())}}
+
+    def prometheus(self):
+        # the snapshot in Prometheus text format
+        with self.lock:
+            histograms = {stage : (list(h.bounds), list(h.counts), h.count, h.sum) 
+                          for stage, h in self.histograms.items()}
+            counters = dict(self.counters)
+        metric = lambda name : 'allitebooks_' + re.sub(r'\W+', '_', name).strip('_')
+        lines = ['# TYPE allitebooks_stage_seconds histogram']
+        for stage, (bounds, counts, count, total) in sorted(histograms.items()):
+            cumulative = 0
+            for bound, n in zip(bounds, counts):
+                cumulative += n
+                lines.append('allitebooks_stage_seconds_bucket{stage="%s",le="%s"} %d' 
+                             % (stage, '+Inf' if bound == float('inf') else bound, cumulative))
+            lines.append('allitebooks_stage_seconds_sum{stage="%s"} %f' % (stage, total))
+            lines.append('allitebooks_stage_seconds_count{stage="%s"} %d' % (stage, count))
+        for (name, labels), n in sorted(counters.items()):
+            lines.append('%s_total%s %s' % (metric(name), 
+                         ('{%s}' % ','.join('%s="%s"' % label for label in labels)) if labels else '', n))
+        for name, value in self.snapshot()['gauges'].items():
+            if value is not None:
+                lines.append('%s %s' % (metric(name), value))
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        snapshot = self.snapshot()
+        lines = ['%s\ncrawl metrics (%.1f s, %.1f KB/s downloaded)' 
+                 % ('=' * 60, snapshot['elapsed'], snapshot['bytes/s'] / 2 ** 10)]
+        lines.append('%-16s %8s %10s %10s %10s %10s' % ('stage', 'count', 'total s', 'mean s', 'p95 s', 'max s'))
+        for stage, h in sorted(snapshot['stages'].items()):
+            lines.append('%-16s %8d %10.2f %10.4f %10.4f %10.4f' 
+                         % (stage, h['count'], h['sum'], h['mean'], h['p95'], h['max']))
+        if snapshot['workers']:
+            lines.append('%-24s %8s %10s %10s %10s' % ('worker', 'files', 'MB', 'busy s', 'MB/s'))
+        for worker, stats in sorted(snapshot['workers'].items()):
+            lines.append('%-24s %8d %10.1f %10.2f %10.2f' 
+                         % (worker, stats['files downloaded'], stats['bytes downloaded'] / 2 ** 20, 
+                            stats['download seconds'], stats['bytes/s'] / 2 ** 20))
+        for counter in snapshot['counters']:
+            if 'worker' in counter and counter['name'] in WORKER_COUNTERS: #per worker above
+                continue
+            labels = ', '.join('%s=%s' % (k, v) for k, v in sorted(counter.items()) if k not in ('name', 'value'))
+            lines.append('%s%s: %s' % (counter['name'], (' (%s)' % labels) if labels else '', counter['value']))
+        for name, value in sorted(snapshot['gauges'].items()):
+            lines.append('%s: %s' % (name, value))
+        return '\n'.join(lines)
+
+METRICS = Metrics()
+
+class TimedLock(object):
+    '''a Lock reporting the time spent waiting for it to METRICS, as the 'lock wait' stage
+'''
+    def __init__(self, stage = 'lock wait'):
+        self.stage = stage
+        self.lock = Lock()
+
+    def acquire(self, blocking = True, timeout = -1):
+        started = perf_counter()
+        acquired = self.lock.acquire(blocking, timeout)
+        METRICS.observe(self.stage, perf_counter() - started)
+        return acquired
+
+    def release(self):
+        self.lock.release()
+
+    def locked(self):
+        return self.lock.locked()
+
+    def __enter__(self):
+        return self.acquire()
 
-DB_PATH = 'allitebooks.xlsx'
-if os.path.exists(DB_PATH):
-    DB = pandas.read_excel(DB_PATH, index_col = 0, dtype = {'link-bookpage' : str, 
+    def __exit__(self, *args):
+        self.release()
+
+class StatusHandler(http.server.BaseHTTPRequestHandler):
+    # GET /metrics in Prometheus text format, anything else as JSON
+    def do_GET(self):
+        if self.path.rstrip('/') == '/metrics':
+            body, content_type = METRICS.prometheus().encode(), 'text/plain; version=0.0.4'
+        else:
+            body = json.dumps(METRICS.snapshot(), ensure_ascii = False, indent = 1).encode('utf-8')
+            content_type = 'application/json'
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args): # keep the console for the crawl
+        pass
+
+def START_STATUS_SERVER(port, host = '127.0.0.1'):
+    # serve METRICS on a local port in a daemon thread, return the server to shutdown()
+    server = http.server.ThreadingHTTPServer((host, port), StatusHandler)
+    Thread(target = server.serve_forever, name = 'StatusServer', daemon = True).start()
+    print('status at http://%s:%d/ (JSON) and /metrics (Prometheus)' % (host, server.server_address[1]))
+    return server
+
+DB_PATH = 'allitebooks.xlsx' # legacy workbook, imported once and exported on demand
+CATALOG_BACKEND = 'sqlite' # 'sqlite': incremental store; 'xlsx': legacy whole-workbook rewrite
+CATALOG_PATH = 'allitebooks.sqlite'
+SNAPSHOT_PATH = 'allitebooks.pkl' # binary snapshot of the catalog, for fast loading
+LINK_COLUMNS = ('link-bookpage', 'link-pdf', 'link-epub')
+DOWNLOAD_COLUMNS = ('downloaded', 'bytes', 'sha256', 'verified') # prefixes of the columns set by 
+                                                                # downloading, never by parsing
+
+def READ_XLSX_DB(path):
+    # load a catalog workbook, drop duplicates and repair the index
+    DB = pandas.read_excel(path, index_col = 0, dtype = {'link-bookpage' : str, 
                                              'link-pdf' : str, 
                                              'link-epub' : str})
     # drop duplicates in 'link-bookpage'
     DB.drop_duplicates(subset = 'link-bookpage', inplace = True)
     # repair nan index
-    if nan in DB.index:
+    if DB.index.isnull().any():
         temp_index = []
         for i in range(DB.shape[0]):
-            if DB.index[i] is nan:
-                if DB.ix[i, 'link-pdf'] is not nan:
-                    url = DB.ix[i, 'link-pdf']
-                elif DB.ix[-10, 'link-epub'] is not nan:
-                    url = DB.ix[i, 'link-epub']
+            if pandas.isnull(DB.index[i]):
+                if pandas.notnull(DB['link-pdf'].iloc[i]):
+                    url = DB['link-pdf'].iloc[i]
+                elif pandas.notnull(DB['link-epub'].iloc[i]):
+                    url = DB['link-epub'].iloc[i]
                 else:
-                    url = DB.ix[i, 'link-bookpage']
+                    url = DB['link-bookpage'].iloc[i]
                 name = FORMAT_TO_FILENAME(os.path.splitext(os.path.split(url.strip('/'))[1])[0])
                 temp_index.append(name)
             else:
@@ -95,34 +369,1373 @@ if os.path.exists(DB_PATH):
     if DB.index.value_counts()[DB.index.value_counts() > 1].any():
         raise Exception('**************Duplicated rows exists: %s'
                         % list(DB.index.value_counts()[DB.index.value_counts() > 1].index))
-else:
-    DB = pandas.DataFrame()
-# repair index name
-if not DB.index.name:
-    DB.index.name = 'name'
+    return DB
+
+CATEGORY_PREFIX = 'CATG***' # wide boolean columns of legacy workbooks
+
+def SPLIT_CATEGORIES(db):
+    # normalize categories into a mapping, name -> [category, ...], from either the legacy
+    # wide 'CATG***<category>' columns or a 'Category' column joined by '; '
+    categories = {}
+    catg_columns = [column for column in db.columns if str(column).startswith(CATEGORY_PREFIX)]
+    if catg_columns:
+        flags = db[catg_columns].notnull() & (db[catg_columns] != False)
+        for name, column in flags.stack().loc[lambda x : x].index:
+            categories.setdefault(name, []).append(column[len(CATEGORY_PREFIX) : ])
+        db = db.drop(columns = catg_columns)
+    if 'Category' in db.columns:
+        for name, value in db['Category'].dropna().items():
+            categories.setdefault(name, []).extend(value.split('; '))
+        db = db.drop(columns = 'Category')
+    return db, categories
+
+def JOIN_CATEGORIES(db, categories):
+    # the reverse of SPLIT_CATEGORIES, for exporting a workbook
+    db = db.copy()
+    db['Category'] = [('; '.join(categories[name]) if categories.get(name) else nan) 
+                      for name in db.index]
+    return db
+
+class CatalogStore(object):
+    '''persistence backend of the catalog, one row per book name, with book
+categories kept as a separate name -> categories mapping
+'''
+    def load(self):
+        '''return (DB, CATEGORIES)
+'''
+        raise NotImplementedError
+
+    def save(self, rows, categories, keep = False):
+        '''rows, a DataFrame (indexed by name) of the changed rows only, merged into the stored 
+ones field by field, missing (nan) fields left as they are
+categories, the categories of these rows, name -> [category, ...]
+keep, the stored fields win, i.e. rows only fill in the fields missing
+'''
+        raise NotImplementedError
+
+    def export_xlsx(self, db, categories, path = DB_PATH):
+        JOIN_CATEGORIES(db, categories).to_excel(path)
+
+    def close(self):
+        pass
+
+class ExcelCatalogStore(CatalogStore):
+    '''legacy backend: rewrite the whole workbook on every save, from the rows of the workbook
+kept since loading, with the saved rows merged in
+'''
+    def __init__(self, path = DB_PATH):
+        self.path = path
+        self.db, self.categories = pandas.DataFrame(), {}
+
+    def load(self):
+        if os.path.exists(self.path):
+            self.db, self.categories = SPLIT_CATEGORIES(READ_XLSX_DB(self.path))
+        return self.db.copy(), {name : list(catgs) for name, catgs in self.categories.items()}
+
+    def save(self, rows, categories, keep = False):
+        known = rows.index[rows.index.isin(self.db.index)]
+        stored, saved = self.db.loc[known], rows.loc[known]
+        merged = stored.combine_first(saved) if keep else saved.combine_first(stored)
+        order = self.db.index.append(rows.index[~rows.index.isin(known)]) #rows of the workbook stay in place
+        self.db = pandas.concat([self.db[~self.db.index.isin(known)], merged, rows.drop(known)], 
+                                sort = False).loc[order]
+        self.db.index.name = 'name'
+        self.categories.update({name : list(catgs) for name, catgs in categories.items()})
+        while True: # the workbook may be locked by Excel, retry until saved
+            try:
+                self.export_xlsx(self.db, self.categories, self.path)
+                break
+            except PermissionError:
+                sleep(3)
+
+class SQLiteCatalogStore(CatalogStore):
+    '''incremental backend: link columns are stored as they are, all other fields of
+a row as a JSON object, so only changed rows are written on each save
+'''
+    def __init__(self, path = CATALOG_PATH, import_path = DB_PATH):
+        self.path = path
+        self.import_path = import_path
+        self.conn = sqlite3.connect(path, timeout = 60, check_same_thread = False)
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS books (
+                             name TEXT PRIMARY KEY, "link-bookpage" TEXT, 
+                             "link-pdf" TEXT, "link-epub" TEXT, fields TEXT)''')
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS categories (
+                             name TEXT, category TEXT, PRIMARY KEY (name, category))''')
+        self.conn.commit()
+        self.write_lock = Lock()
+
+    def __to_json_value__(self, value):
+        if hasattr(value, 'item'): # numpy scalars
+            value = value.item()
+        return value
+
+    def load(self):
+        rows = self.conn.execute('SELECT name, "link-bookpage", "link-pdf", "link-epub", fields '
+                                 'FROM books ORDER BY name').fetchall()
+        if not rows and os.path.exists(self.import_path):
+            print('importing %s into %s...' % (self.import_path, self.path))
+            DB, categories = SPLIT_CATEGORIES(READ_XLSX_DB(self.import_path))
+            self.save(DB, categories)
+            return DB, categories
+        records = []
+        for name, bookpage, pdf, epub, fields in rows:
+            record = json.loads(fields)
+            record.update(zip(LINK_COLUMNS, (bookpage, pdf, epub)))
+            records.append(record)
+        DB = pandas.DataFrame(records, index = pandas.Index([row[0] for row in rows]))
+        for column in LINK_COLUMNS:
+            if column in DB.columns:
+                DB[column] = DB[column].astype(object)
+        DB, categories = SPLIT_CATEGORIES(DB)
+        if categories: # rows stored before categories were normalized, migrate once
+            self.save(DB, categories)
+        for name, category in self.conn.execute('SELECT name, category FROM categories'):
+            categories.setdefault(name, [])
+            if category not in categories[name]:
+                categories[name].append(category)
+        return DB, categories
+
+    def save(self, rows, categories, keep = False):
+        params = []
+        for name, row in rows.iterrows():
+            row = row.dropna()
+            links = [row.get(column) for column in LINK_COLUMNS]
+            fields = {key : self.__to_json_value__(value) 
+                      for key, value in row.items() if key not in LINK_COLUMNS}
+            params.append([name] + links + [json.dumps(fields, ensure_ascii = False)])
+        with self.write_lock:
+            self.conn.executemany('INSERT INTO books VALUES (?, ?, ?, ?, ?) ON CONFLICT (name) DO UPDATE SET '
+                                  + ', '.join('"%s" = coalesce(excluded."%s", "%s")' % (column, column, column) 
+                                              for column in LINK_COLUMNS) 
+                                  + (', fields = json_patch(excluded.fields, fields)' if keep else 
+                                     ', fields = json_patch(fields, excluded.fields)'), params)
+            self.conn.executemany('DELETE FROM categories WHERE name = ?', 
+                                  [(name, ) for name in categories])
+            self.conn.executemany('INSERT OR IGNORE INTO categories VALUES (?, ?)', 
+                                  [(name, category) for name in categories 
+                                   for category in categories[name]])
+            self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+def OPEN_CATALOG_STORE(backend = CATALOG_BACKEND):
+    if backend == 'sqlite':
+        return SQLiteCatalogStore()
+    elif backend == 'xlsx':
+        return ExcelCatalogStore()
+    raise ValueError('Unknown catalog backend: %s' % backend)
+
+BUFFER_SIZE = 100 # merge buffered rows into the catalog every BUFFER_SIZE records, or once per page
+
+class LinkIndex(object):
+    '''hashed lookups maintained alongside DB, instead of scanning its columns:
+book page url -> name, pdf/epub link -> name, and name -> book page url
+'''
+    def __init__(self, db = None):
+        self.bookpages = {}
+        self.files = {'pdf' : {}, 'epub' : {}}
+        self.names = {}
+        if db is not None:
+            self.rebuild(db)
+
+    def rebuild(self, db):
+        self.bookpages.clear()
+        self.names.clear()
+        for links in self.files.values():
+            links.clear()
+        if 'link-bookpage' in db.columns:
+            for name, link in zip(db.index, db['link-bookpage']):
+                if isinstance(link, str):
+                    self.bookpages[link] = name
+                    self.names[name] = link
+        for ext, links in self.files.items():
+            if 'link-%s' % ext in db.columns:
+                links.update((link, name) for name, link in zip(db.index, db['link-%s' % ext])
+                             if isinstance(link, str))
+
+    def add(self, name, row):
+        '''row, a mapping with 'link-bookpage' / 'link-pdf' / 'link-epub' keys
+'''
+        link = row.get('link-bookpage')
+        if isinstance(link, str):
+            self.bookpages[link] = name
+            self.names[name] = link
+        for ext, links in self.files.items():
+            link = row.get('link-%s' % ext)
+            if isinstance(link, str):
+                links[link] = name
+
+    def __contains__(self, bookpage):
+        return bookpage in self.bookpages
+
+    def name_of(self, link, ext = None):
+        '''book name of a book page link, or of a pdf/epub link if ext given
+'''
+        if ext:
+            return self.files[ext].get(link)
+        return self.bookpages.get(link)
+
+    def bookpage_of(self, name):
+        return self.names.get(name)
+
+YEAR = re.compile(r'\b((?:19|20)\d{2})\b') # the year of 'January 20, 2014', '2014-02-24', '20 Jun. 2009'
+YEARS = frozenset(str(year) for year in range(1900, 2030)) # the years counted, others are typos
+
+def NORMALIZE_YEARS(years):
+    # a Series of dates as shown on book pages -> 'yyyy', or None, in one vectorized pass
+    years = years.astype(object).where(years.notnull(), '').astype(str).str.extract(YEAR.pattern, expand = False)
+    return years.astype(object).where(years.isin(YEARS), None)
+
+def NORMALIZE_YEAR(year):
+    # NORMALIZE_YEARS of a single date
+    match = YEAR.search(str(year)) if year is not None and year == year else None
+    return match.group(1) if match and match.group(1) in YEARS else None
+
+class CatalogStats(object):
+    '''book counts by category, by year and by both, for counts.xlsx: built with one groupby 
+over the book -> category table, then maintained as books are added
+'''
+    def __init__(self, db = None, categories = None):
+        self.books = {} # name -> (year, [category, ...]), as counted
+        self.by_category = Counter() # book-category pairs
+        self.by_year = Counter() # books
+        self.by_both = Counter() # (year, category) -> book-category pairs
+        if db is not None:
+            self.rebuild(db, categories)
+
+    def rebuild(self, db, categories):
+        years = NORMALIZE_YEARS(db['Year']) if 'Year' in db.columns else \
+                pandas.Series(None, index = db.index, dtype = object)
+        table = pandas.DataFrame([(name, catg) for name, catgs in categories.items() 
+                                  if name in db.index for catg in catgs], 
+                                 columns = ['name', 'Category']) # book -> category
+        table['Year'] = table['name'].map(years)
+        both = table.groupby(['Year', 'Category'], dropna = False).size()
+        self.by_both = Counter({(year if isinstance(year, str) else None, catg) : n 
+                                for (year, catg), n in both.items()})
+        self.by_category = Counter()
+        for (year, catg), n in self.by_both.items():
+            self.by_category[catg] += n
+        self.by_year = Counter(year for year in years if year)
+        self.books = {name : (year, categories.get(name, [])) for name, year in years.items()}
+
+    def add(self, name, row, categories):
+        # count a new or updated book, the caller should hold the catalog lock
+        if name in self.books:
+            year, old = self.books[name]
+            self.by_year[year] -= 1
+            for catg in old:
+                self.by_category[catg] -= 1
+                self.by_both[(year, catg)] -= 1
+        year = NORMALIZE_YEAR(row.get('Year'))
+        self.books[name] = (year, list(categories))
+        self.by_year[year] += 1
+        for catg in categories:
+            self.by_category[catg] += 1
+            self.by_both[(year, catg)] += 1
+
+    def frames(self):
+        '''(category counts, annual counts by category with a 'Summary' column of books)
+'''
+        catg_counts = pandas.Series({catg : n for catg, n in self.by_category.items() if n}, 
+                                    name = 'Books Counts', dtype = int).sort_values(ascending = False)
+        years = sorted(year for year, n in self.by_year.items() if year and n)
+        annuals = pandas.Series({key : n for key, n in self.by_both.items() if key[0] and n}, dtype = int)
+        if len(annuals):
+            annuals = annuals.unstack(fill_value = 0)
+        else:
+            annuals = pandas.DataFrame(index = years)
+        annuals = annuals.reindex(years, fill_value = 0)
+        annuals.index.name = 'Year'
+        annuals['Summary'] = [self.by_year[year] for year in years]
+        return catg_counts, annuals
+
+SEARCH_PATH = 'allitebooks-search.sqlite' # full-text index of the catalog
+SEARCH_COLUMNS = ('name', 'Author', 'ISBN-10', 'Book Description') # indexed fields of a row
+SEARCH_WEIGHTS = (10.0, 5.0, 5.0, 1.0, 3.0) # bm25 weights of the fields and the categories
+SEARCH_LIMIT = 20
+
+SearchHit = namedtuple('SearchHit', 'name year categories score snippet')
+
+class SearchIndex(object):
+    '''SQLite FTS5 index of the catalog in its own file: names, authors, ISBNs, descriptions 
+and categories, ranked by bm25, with category and year filters on plain tables. It is 
+kept by the catalog writer as books are added, and queried without loading the catalog.
+Books are keyed by name, so processes sharing a catalog share the index as well.
+'''
+    def __init__(self, path = SEARCH_PATH):
+        self.path = path
+        self.lock = Lock() # one connection, shared by the writer and the readers
+
+    def __getattr__(self, name): # opened on the first use
+        if name != 'conn':
+            raise AttributeError(name)
+        conn = sqlite3.connect(self.path, timeout = 60, check_same_thread = False)
+        conn.execute('CREATE TABLE IF NOT EXISTS books (id INTEGER PRIMARY KEY, name TEXT UNIQUE, year INTEGER)')
+        conn.execute('CREATE INDEX IF NOT EXISTS books_year ON books (year)')
+        conn.execute('''CREATE TABLE IF NOT EXISTS book_categories (
+                        category TEXT COLLATE NOCASE, id INTEGER, PRIMARY KEY (category, id)) WITHOUT ROWID''')
+        conn.execute('CREATE INDEX IF NOT EXISTS book_categories_id ON book_categories (id)')
+        conn.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS books_text USING fts5(
+                        name, author, isbn, description, categories, tokenize = 'porter unicode61')''')
+        conn.commit()
+        self.conn = conn
+        return conn
+
+    def __text__(self, value):
+        if value is None or value != value: # None or NaN
+            return ''
+        return str(value)
+
+    def __write__(self, name, row, categories):
+        # insert or replace one book, the caller should hold the lock and commit
+        year = NORMALIZE_YEAR(row.get('Year'))
+        year = int(year) if year else None
+        self.conn.execute('INSERT INTO books (name, year) VALUES (?, ?) '
+                          'ON CONFLICT (name) DO UPDATE SET year = excluded.year', (name, year))
+        book_id = self.conn.execute('SELECT id FROM books WHERE name = ?', (name, )).fetchone()[0]
+        self.conn.execute('DELETE FROM books_text WHERE rowid = ?', (book_id, ))
+        self.conn.execute('DELETE FROM book_categories WHERE id = ?', (book_id, ))
+        texts = [name] + [self.__text__(row.get(column)) for column in SEARCH_COLUMNS[1:]]
+        self.conn.execute('INSERT INTO books_text (rowid, name, author, isbn, description, categories) '
+                          'VALUES (?, ?, ?, ?, ?, ?)', [book_id] + texts + ['; '.join(categories)])
+        self.conn.executemany('INSERT OR IGNORE INTO book_categories VALUES (?, ?)', 
+                              [(category, book_id) for category in categories])
+
+    def add(self, name, row, categories):
+        # index a new or updated book, written on the next commit()
+        with self.lock:
+            self.__write__(name, row, categories)
+
+    def commit(self):
+        with self.lock:
+            self.conn.commit()
+
+    def sync(self, db, categories):
+        # index the books of the catalog missing in the index, e.g. all of them on the first run
+        with self.lock:
+            count = self.conn.execute('SELECT count(*) FROM books').fetchone()[0]
+            if count == len(db):
+                return
+            indexed = {name for name, in self.conn.execute('SELECT name FROM books')}
+            missing = ~db.index.isin(indexed)
+            print('indexing %d books into %s...' % (missing.sum(), self.path))
+            columns = [column for column in SEARCH_COLUMNS[1:] + ('Year', ) if column in db.columns]
+            for name, values in zip(db.index[missing], db.loc[missing, columns].itertuples(index = False, name = None)):
+                self.__write__(name, dict(zip(columns, values)), categories.get(name, []))
+            self.conn.commit()
+
+    def __match__(self, query):
+        # words of a query as FTS5 phrases, so that 'c++' or 'node.js' is no syntax error
+        words = re.findall(r'\w+', query)
+        return ' '.join('"%s"' % word for word in words)
+
+    def search(self, query = '', categories = None, year = None, limit = SEARCH_LIMIT, raw = False):
+        '''books ranked by relevance to query, best first, as SearchHit-s
+query, words all to be found, or FTS5 query syntax with raw = True, e.g. 'python NOT django'
+categories, [category, ...], books in any of them only
+year, yyyy or (from, to), books published in them only
+'''
+        match = query if raw else self.__match__(query)
+        where, params = [], []
+        if match:
+            where.append('books_text MATCH ?')
+            params.append(match)
+        if year is not None:
+            first, last = year if isinstance(year, (tuple, list)) else (year, year)
+            where.append('books.year BETWEEN ? AND ?')
+            params += [int(first), int(last)]
+        if categories:
+            where.append('books.id IN (SELECT id FROM book_categories WHERE category IN (%s))' 
+                         % ', '.join('?' * len(categories)))
+            params += list(categories)
+        if match:
+            sql = ('SELECT books.id, bm25(books_text, %s) FROM books_text JOIN books ON books.id = books_text.rowid '
+                   % ', '.join(map(str, SEARCH_WEIGHTS)))
+        else: # filters only, newest first
+            sql = 'SELECT books.id, 0.0 FROM books '
+        sql += 'WHERE ' + (' AND '.join(where) or '1') + (' ORDER BY 2, books.year DESC' if match else 
+                                                       ' ORDER BY books.year DESC, books.name') + ' LIMIT ?'
+        with self.lock:
+            # rank first, then snippets and categories of the top books only
+            ranked = self.conn.execute(sql, params + [limit]).fetchall()
+            ids = ', '.join(str(book_id) for book_id, score in ranked)
+            snippets = {}
+            if match and ranked:
+                snippets = dict(self.conn.execute('SELECT rowid, snippet(books_text, 3, \'[\', \']\', \'...\', 12) '
+                                                  'FROM books_text WHERE books_text MATCH ? AND rowid IN (%s)' % ids, 
+                                                  (match, )))
+            books = {book_id : (name, year) for book_id, name, year in 
+                     self.conn.execute('SELECT id, name, year FROM books WHERE id IN (%s)' % ids)}
+            catgs = {}
+            for book_id, category in self.conn.execute('SELECT id, category FROM book_categories '
+                                                       'WHERE id IN (%s)' % ids):
+                catgs.setdefault(book_id, []).append(category)
+        return [SearchHit(books[book_id][0], books[book_id][1], catgs.get(book_id, []), 0.0 - score, 
+                          snippets.get(book_id, '')) for book_id, score in ranked]
+
+    def close(self):
+        if 'conn' in self.__dict__:
+            self.conn.close()
+            del self.conn
+
+class Catalog(object):
+    '''the catalog of books, loaded from its store on the first access to store / db / 
+categories / index, from a pickle snapshot instead while the store file is unchanged
+db, DataFrame of books indexed by name
+categories, name -> [category, ...]
+index, LinkIndex of db
+stats, CatalogStats of db
+search_index, SearchIndex of db, opened without loading the catalog
+buffer, new/updated rows not merged into db yet, name -> {column : value}
+dirty, names of rows changed since the last flush
+shared, other processes write the store too (ShardEngine), rows are merged there by name
+patches, fields updated while shared, name -> {column : value}, written without the rest of the row
+Changed by CATALOG_WRITER only, other threads hold lock while reading across updates.
+'''
+    LAZY = ('store', 'db', 'categories', 'index', 'stats')
+
+    def __init__(self, backend = CATALOG_BACKEND, snapshot_path = SNAPSHOT_PATH, search_path = SEARCH_PATH):
+        self.backend = backend
+        self.snapshot_path = snapshot_path
+        self.search_index = SearchIndex(search_path)
+        self.shared = False
+        self.patches = {}
+        self.buffer = {}
+        self.dirty = set()
+        self.load_lock = Lock()
+        self.lock = TimedLock('catalog lock wait') # held by CATALOG_WRITER while applying updates
+
+    def __getattr__(self, name): # called for attributes not loaded yet only
+        if name not in Catalog.LAZY:
+            raise AttributeError(name)
+        self.load()
+        return self.__dict__[name]
+
+    def __signature__(self):
+        # the store file as of now, the snapshot is valid only for the same one
+        try:
+            stat = os.stat(self.store.path)
+        except (AttributeError, OSError):
+            return None
+        return (self.backend, os.path.abspath(self.store.path), stat.st_mtime_ns, stat.st_size)
+
+    def load(self):
+        with self.load_lock:
+            if 'db' in self.__dict__:
+                return
+            self.store = OPEN_CATALOG_STORE(self.backend)
+            db = None
+            signature = self.__signature__()
+            if signature and os.path.exists(self.snapshot_path):
+                try:
+                    with open(self.snapshot_path, 'rb') as f:
+                        saved, db, categories = pickle.load(f)
+                    if saved != signature:
+                        db = None
+                except Exception: # unreadable snapshot, load from the store
+                    db = None
+            if db is None:
+                db, categories = self.store.load()
+                # repair index name
+                if not db.index.name:
+                    db.index.name = 'name'
+                # repair 'downloaded' flags read back as 0/1/nan
+                for column in ('downloaded (PDF)?', 'downloaded (ePub)?'):
+                    if column in db.columns:
+                        db[column] = db[column].fillna(0).astype(bool)
+                self.__dump__(db, categories)
+            self.categories = categories
+            self.index = LinkIndex(db)
+            self.stats = CatalogStats(db, categories)
+            self.search_index.sync(db, categories)
+            self.db = db
+
+    def __dump__(self, db, categories):
+        signature = self.__signature__()
+        if signature and not self.shared: #stale at once while other processes write the store
+            part = PART_PATH(self.snapshot_path)
+            with open(part, 'wb') as f:
+                pickle.dump((signature, db, categories), f, protocol = pickle.HIGHEST_PROTOCOL)
+            os.replace(part, self.snapshot_path)
+
+    def snapshot(self):
+        # flush, then refresh the snapshot, the caller should hold the lock
+        self.flush()
+        self.__dump__(self.db, self.categories)
+
+    def add(self, name, record, categories):
+        # buffer a parsed book, the caller should hold the lock
+        self.buffer[name] = record #merged into db in bulk
+        self.categories[name] = categories
+        self.index.add(name, record)
+        self.stats.add(name, record, categories)
+        self.search_index.add(name, record, categories)
+        if len(self.buffer) >= BUFFER_SIZE:
+            self.merge()
+
+    def merge(self):
+        # merge buffered rows into db in bulk, the caller should hold the lock
+        if not self.buffer:
+            return
+        rows = pandas.DataFrame.from_dict(self.buffer, orient = 'index')
+        known = rows.index[rows.index.isin(self.db.index)]
+        kept = [column for column in self.db.columns if column.startswith(DOWNLOAD_COLUMNS)]
+        if len(known) and kept: #books parsed again, e.g. offline, keep their download state
+            for column in kept:
+                if column not in rows.columns:
+                    rows[column] = nan
+                rows[column] = rows[column].astype(object)
+                rows.loc[known, column] = self.db.loc[known, column].astype(object)
+        db = pandas.concat([self.db[~self.db.index.isin(rows.index)], rows], sort = False)
+        db.index.name = 'name'
+        self.db = db
+        self.dirty.update(rows.index)
+        self.buffer = {}
+
+    def update(self, name, fields):
+        # set fields {column : value} of a book, buffered or merged already
+        if name in self.db.index: #also while buffered, merge keeps the download state of db
+            for column, value in fields.items():
+                self.db.loc[name, column] = value
+        if name in self.buffer:
+            self.buffer[name].update(fields)
+        elif self.shared: #not the whole row, which may be stale, or recorded by another process
+            self.patches.setdefault(name, {}).update(fields)
+        elif name in self.db.index:
+            self.dirty.add(name)
+
+    def mark_downloaded(self, name, ext, size = None, sha256 = None):
+        # set 'downloaded (PDF)?' / 'downloaded (ePub)?' of a book, its Content-Length and
+        # SHA-256 if known
+        fmt = {'pdf' : 'PDF', 'epub' : 'ePub'}[ext]
+        fields = {'downloaded (%s)?' % fmt : True}
+        if size:
+            fields['bytes (%s)' % fmt] = size
+        if sha256:
+            fields['sha256 (%s)' % fmt] = sha256
+        self.update(name, fields)
+
+    def flush(self):
+        # persist changed rows only, the caller should hold the lock
+        self.merge()
+        names = [name for name in self.dirty if name in self.db.index]
+        patches = self.patches #cleared once saved, like dirty, kept for the next flush otherwise
+        if names or patches:
+            with METRICS.timed('catalog write'):
+                if names:
+                    rows = self.db.loc[names]
+                    categories = {name : self.categories[name] for name in names if name in self.categories}
+                    if self.shared: #books parsed here, maybe updated by other processes already
+                        self.store.save(rows, categories, keep = True)
+                    else:
+                        self.store.save(rows, categories)
+                if patches: #merged into the rows by the store
+                    self.store.save(pandas.DataFrame.from_dict(patches, orient = 'index'), {})
+            self.search_index.commit()
+        self.dirty.clear()
+        self.patches = {}
+
+    def export_xlsx(self, path = DB_PATH):
+        self.flush()
+        self.store.export_xlsx(self.db, self.categories, path)
+
+CATALOG = Catalog()
+
+FLUSH_INTERVAL = 5 # seconds between flushes of the catalog writer
+WRITER_BATCH = 1000 # updates applied under one hold of the catalog lock at most
+
+class CatalogWriter(Thread):
+    '''the only thread changing the catalog: producers and downloaders queue their updates
+and go on, updates are applied in batches under CATALOG.lock, and persisted every 
+FLUSH_INTERVAL seconds, or at once on flush()
+'''
+    def __init__(self, interval = FLUSH_INTERVAL):
+        super().__init__(name = 'CatalogWriter', daemon = True)
+        self.interval = interval
+        self.updates = Queue() # (Catalog method, args), or ('flush', Event)
+        self.start_lock = Lock()
+
+    def __put__(self, method, *args):
+        with self.start_lock: # started on the first update
+            if not self.is_alive():
+                self.start()
+        self.updates.put((method, args))
+
+    def add(self, name, record, categories):
+        self.__put__('add', name, record, categories)
+
+    def update(self, name, fields):
+        self.__put__('update', name, fields)
+
+    def mark_downloaded(self, name, ext, size = None, sha256 = None):
+        self.__put__('mark_downloaded', name, ext, size, sha256)
+
+    def flush(self):
+        # block until all updates queued so far are applied and persisted
+        done = Event()
+        self.__put__('flush', done)
+        done.wait()
+
+    def run(self):
+        global CATALOG
+        flushed = time()
+        while True:
+            try:
+                batch = [self.updates.get(timeout = max(flushed + self.interval - time(), 0.01))]
+            except Empty:
+                batch = []
+            while batch and len(batch) < WRITER_BATCH:
+                try:
+                    batch.append(self.updates.get_nowait())
+                except Empty:
+                    break
+            waiting = [args[0] for method, args in batch if method == 'flush']
+            try:
+                with CATALOG.lock:
+                    for method, args in batch:
+                        if method == 'flush':
+                            continue
+                        try:
+                            getattr(CATALOG, method)(*args)
+                        except Exception as e: # this update only, the rest of the batch is applied
+                            print('\n************************%s: %s of [%s] failed: %s' 
+                                  % (self.name, method, args[0], e))
+                    if waiting or (time() - flushed >= self.interval):
+                        CATALOG.flush()
+                        flushed = time()
+            except Exception as e: # keep writing, the rows stay dirty until the next flush
+                print('\n************************%s: %s' % (self.name, e))
+            finally:
+                for done in waiting:
+                    done.set()
+
+CATALOG_WRITER = CatalogWriter()
+
+def __getattr__(name):
+    # module attributes of earlier versions, loaded lazily now
+    attrs = {'DB' : 'db', 'CATEGORIES' : 'categories', 'DB_INDEX' : 'index', 'STORE' : 'store'}
+    if name in attrs:
+        return getattr(CATALOG, attrs[name])
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
 
 BUG_DBFILE = 'bug.xlsx'
-BUG_DB = pandas.DataFrame()
-BUG_DB.index.name = 'name'
+BUG_ROWS = {} # error database rows, name -> {'Link' : ..., 'Error Msg.' : ...}
+
+class AtomicCounter(object):
+    '''a counter shared by threads without a lock, next() of itertools.count being atomic
+'''
+    def __init__(self):
+        self.counter = itertools.count(1)
+        self.value = 0 # the latest value handed out, for reporting
+
+    def increment(self):
+        value = next(self.counter)
+        self.value = max(self.value, value)
+        return value
+
+DOWNLOADED_COUNT = AtomicCounter()
+ERROR_COUNT = AtomicCounter()
+
+CHUNK_SIZE = 2 ** 16 # bytes per read when streaming a file to disk
+PART_SUFFIX = '.part' # files being downloaded, never taken as downloaded ones
+RESUME_SUFFIX = '.json' # resume state next to a partial file, i.e. '<file>.part.json'
+
+def PART_PATH(path):
+    # a temporary file next to path of this process and thread only, e.g. to os.replace path
+    return '%s.%d-%d%s' % (path, os.getpid(), get_ident(), PART_SUFFIX)
+DOWNLOAD_PROGRESS = {} # downloads in progress, filename -> {'bytes', 'total', 'bytes/s'}
+
+BUG_FILE = 'bug.txt' # legacy free-text error log, imported once into ERROR_JOURNAL_FILE
+ERROR_JOURNAL_FILE = 'bug.jsonl'
+
+class ErrorJournal(object):
+    '''one JSON record per failed url, {'url', 'kind' ('bookpage' / 'file'), 'file', 'error', 
+'error_class', 'attempts', 'last_attempt'}, appended on each failure and indexed by url.
+The journal is loaded on the first access to records, and compacted to the latest record 
+of each url then.
+'''
+    def __init__(self, path = ERROR_JOURNAL_FILE, legacy_path = BUG_FILE):
+        self.path = path
+        self.legacy_path = legacy_path
+        self.lock = RLock() # held by record() while loading
+
+    def __getattr__(self, name): # called until records are loaded only
+        if name != 'records':
+            raise AttributeError(name)
+        self.load()
+        return self.__dict__['records']
+
+    def load(self):
+        with self.lock:
+            if 'records' in self.__dict__:
+                return
+            self.records = {} # url -> record
+            self.__load__()
+        if not CATALOG.shared: #other processes append to the journal meanwhile
+            self.compact()
+
+    def __load__(self):
+        if os.path.exists(self.path):
+            with open(self.path, encoding = 'utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError: # torn last line
+                        continue
+                    if record.get('resolved'):
+                        self.records.pop(record['url'], None)
+                    else:
+                        self.records[record['url']] = record
+        elif os.path.exists(self.legacy_path):
+            self.__import_legacy__()
 
-BUG_FILE = 'bug.txt'
-if not os.path.exists(BUG_FILE):
-    f = open(BUG_FILE, 'wt')
-    f.close()
+    def __import_legacy__(self):
+        # lines like "(ERROR-1) <ctime>****...No pdf/epub anchor for [url]"
+        #         or "(ERROR-2) <ctime>****...Downloader-1 >> [url] download failed: <error>"
+        with open(self.legacy_path) as f:
+            for line in f:
+                if '[' not in line:
+                    continue
+                url = line.split('[')[1].split(']')[0]
+                record = self.records.get(url, {'url' : url, 'attempts' : 0})
+                if 'No pdf/epub anchor' in line:
+                    record.update(kind = 'bookpage', error = 'No pdf/epub anchor', error_class = 'NoAnchor')
+                else:
+                    record.update(kind = 'file', error = line.split('download failed:')[1].strip(), 
+                                  error_class = 'Exception')
+                record.update(attempts = record['attempts'] + 1, last_attempt = None)
+                self.records[url] = record
+
+    def compact(self):
+        with self.lock:
+            part = PART_PATH(self.path)
+            with open(part, 'wt', encoding = 'utf-8') as f:
+                for record in self.records.values():
+                    f.write(json.dumps(record, ensure_ascii = False) + '\n')
+            os.replace(part, self.path)
+
+    def __append__(self, record):
+        with open(self.path, 'at', encoding = 'utf-8') as f:
+            f.write(json.dumps(record, ensure_ascii = False) + '\n')
+
+    def record(self, url, kind, error, error_class = None, file = None):
+        with self.lock:
+            record = self.records.get(url, {'url' : url, 'attempts' : 0})
+            record.update(kind = kind, error = str(error), 
+                          error_class = error_class or type(error).__name__, 
+                          attempts = record['attempts'] + 1, last_attempt = time())
+            if file:
+                record['file'] = file
+            self.records[url] = record
+            self.__append__(record)
+
+    def resolve(self, url):
+        # forget an url which has been fetched successfully
+        with self.lock:
+            if self.records.pop(url, None):
+                self.__append__({'url' : url, 'resolved' : True})
+
+    def __contains__(self, url):
+        return url in self.records
+
+    def get(self, url):
+        return self.records.get(url)
 
-DOWNLOADED_COUNT = 0
-ERROR_COUNT = 0
+    def values(self):
+        with self.lock:
+            return list(self.records.values())
+
+ERROR_JOURNAL = ErrorJournal()
 
 START_PAGE_FILE = 'start_page.txt'
+PAGE_LINK = re.compile(r'/page/(\d+)/?$') # pagination links of listing pages
+PAGE_COUNT = re.compile(r'(\d+)\s+Pages\b')
+
+BASE_URL = 'http://www.allitebooks.com' # listing pages are <BASE_URL>/page/<n>
+ENGINES = ('threads', 'asyncio', 'shard')
+CONCURRENCY = {'listing' : 2, 'bookpage' : 4, 'download' : 8} # concurrent requests of each kind
 
 socket.setdefaulttimeout(60) #  set socket level default timeout as 60s
 
+RATE_BUDGETS = { # requests per second of each request class: initial rate, floor, ceiling, burst
+    'listing' : {'rate' : 0.5, 'min' : 0.02, 'max' : 4.0, 'burst' : 2},
+    'bookpage' : {'rate' : 1.0, 'min' : 0.02, 'max' : 8.0, 'burst' : 4},
+    'file' : {'rate' : 0.5, 'min' : 0.02, 'max' : 4.0, 'burst' : 8},
+}
+BACKOFF_BASE = 3 # seconds of the first back-off, doubled on each consecutive failure
+BACKOFF_CAP = 300 # seconds
+
+def IS_THROTTLED(e):
+    # 429 Too Many Requests, or a 5xx server error: slow down and retry
+    return isinstance(e, urllib.error.HTTPError) and (e.code == 429 or e.code >= 500)
+
+class AdaptiveRateLimiter(object):
+    '''a token bucket per request class ('listing', 'bookpage', 'file') that all requests go
+through: the rate is raised additively while responses are healthy, and cut by half on
+time-outs, resets and 429/5xx responses, with an exponential back-off plus jitter
+'''
+    def __init__(self, budgets = RATE_BUDGETS, increase = 0.05, decrease = 0.5, 
+                 base = BACKOFF_BASE, cap = BACKOFF_CAP):
+        self.increase = increase # requests per second added after each success
+        self.decrease = decrease # rate factor after each failure
+        self.base = base
+        self.cap = cap
+        self.buckets = {}
+        self.lock = Lock()
+        self.configure(budgets)
+
+    def configure(self, budgets):
+        '''budgets, {request class : {'rate', 'min', 'max', 'burst'}}, missing keys are kept
+'''
+        with self.lock:
+            for kind, budget in budgets.items():
+                bucket = self.buckets.setdefault(kind, dict(RATE_BUDGETS.get(kind, RATE_BUDGETS['file']), 
+                                                            tokens = 1.0, stamp = time(), failures = 0))
+                bucket.update(budget)
+
+    def acquire(self, kind):
+        # block until a request of this class may be sent
+        while True:
+            with self.lock:
+                bucket = self.buckets[kind]
+                now = time()
+                bucket['tokens'] = min(bucket['burst'], 
+                                       bucket['tokens'] + (now - bucket['stamp']) * bucket['rate'])
+                bucket['stamp'] = now
+                if bucket['tokens'] >= 1:
+                    bucket['tokens'] -= 1
+                    return
+                wait = (1 - bucket['tokens']) / bucket['rate']
+            sleep(wait)
+
+    def success(self, kind):
+        with self.lock:
+            bucket = self.buckets[kind]
+            bucket['rate'] = min(bucket['max'], bucket['rate'] + self.increase)
+            bucket['failures'] = 0
+
+    def failure(self, kind, e = None):
+        '''slow down after a failed request, return the seconds to back off before retrying
+'''
+        METRICS.count('retries', kind = kind, error = ('HTTP %d' % e.code) if isinstance(
+                      e, urllib.error.HTTPError) else type(e).__name__)
+        with self.lock:
+            bucket = self.buckets[kind]
+            bucket['rate'] = max(bucket['min'], bucket['rate'] * self.decrease)
+            bucket['failures'] += 1
+            delay = min(self.cap, self.base * 2 ** (bucket['failures'] - 1))
+        delay = random.uniform(delay / 2, delay) # jitter, so that threads don't retry together
+        retry_after = getattr(e, 'headers', None) and e.headers.get('Retry-After')
+        if retry_after and retry_after.isdigit():
+            delay = max(delay, min(self.cap, int(retry_after)))
+        return delay
+
+RATE_LIMITER = AdaptiveRateLimiter()
+
+BANDWIDTH = None # bytes per second of all downloads of a process together, None for no limit
+
+class BandwidthLimiter(object):
+    '''a token bucket of bytes shared by all downloads of this process, taken chunk by chunk 
+as they are read, so that the downloads together stay within rate bytes per second.
+Worker processes of the shard engine have one each, see SHARD_WORKERS(bandwidth).
+'''
+    def __init__(self, rate = BANDWIDTH):
+        self.rate = rate
+        self.tokens = 0.0
+        self.stamp = time()
+        self.lock = Lock()
+
+    def acquire(self, size):
+        # take size bytes, sleeping off any debt, a second of rate may be taken ahead at most
+        if not self.rate:
+            return
+        with self.lock:
+            now = time()
+            self.tokens = min(self.rate, self.tokens + (now - self.stamp) * self.rate) - size
+            self.stamp = now
+            wait = -self.tokens / self.rate
+        if wait > 0:
+            METRICS.observe('bandwidth wait', wait)
+            sleep(wait)
+
+BANDWIDTH_LIMITER = BandwidthLimiter()
+
+POOL_SIZE = 8 # idle keep-alive connections kept per host
+DNS_TTL = 300 # seconds to cache name resolutions
+
+class PooledResponse(object):
+    '''a response of HTTPConnectionPool, its connection goes back to the pool once the body
+has been read completely, and is dropped if closed earlier
+'''
+    def __init__(self, pool, key, conn, resp, url):
+        self.pool = pool
+        self.key = key
+        self.conn = conn
+        self.resp = resp
+        self.url = url
+        self.status = resp.status
+        self.reason = resp.reason
+        self.headers = resp.headers
+
+    def read(self, amt = None):
+        data = self.resp.read(amt)
+        if self.conn and self.resp.isclosed(): # body exhausted
+            self.pool.release(self.key, self.conn, reusable = not self.resp.will_close)
+            self.conn = None
+        return data
+
+    def close(self):
+        if self.conn:
+            self.resp.close()
+            self.pool.release(self.key, self.conn, reusable = False)
+            self.conn = None
+
+class HTTPConnectionPool(object):
+    '''thread-safe keep-alive connections per (scheme, host, port), with DNS results cached,
+used by LinkProducer and Downloaders instead of a new connection per urlopen
+'''
+    def __init__(self, pool_size = POOL_SIZE, dns_ttl = DNS_TTL, max_redirects = 5):
+        self.pool_size = pool_size # idle connections kept per host
+        self.dns_ttl = dns_ttl
+        self.max_redirects = max_redirects
+        self.idle = {} # (scheme, host, port) -> [connection, ...]
+        self.dns = {} # (host, port) -> (expires, [sockaddr, ...])
+        self.lock = Lock()
+
+    def resolve(self, host, port):
+        with self.lock:
+            expires, addrs = self.dns.get((host, port), (0, None))
+        if expires < time():
+            addrs = [info[4] for info in socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)]
+            with self.lock:
+                self.dns[(host, port)] = (time() + self.dns_ttl, addrs)
+        return addrs
+
+    def __create_connection__(self, address, timeout = socket._GLOBAL_DEFAULT_TIMEOUT, 
+                              source_address = None):
+        # replaces socket.create_connection of pooled connections, using cached addresses
+        host, port = address
+        err = None
+        for addr in self.resolve(host, port):
+            try:
+                return socket.create_connection(addr[ : 2], timeout, source_address)
+            except OSError as e:
+                err = e
+        with self.lock: # addresses may be outdated
+            self.dns.pop((host, port), None)
+        raise err
+
+    def __acquire__(self, key):
+        with self.lock:
+            if self.idle.get(key):
+                return self.idle[key].pop(), True
+        scheme, host, port = key
+        if scheme == 'https':
+            conn = http.client.HTTPSConnection(host, port)
+        else:
+            conn = http.client.HTTPConnection(host, port)
+        conn._create_connection = self.__create_connection__
+        return conn, False
+
+    def release(self, key, conn, reusable = True):
+        with self.lock:
+            idle = self.idle.setdefault(key, [])
+            if reusable and len(idle) < self.pool_size:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def urlopen(self, url, headers = None, method = 'GET'):
+        '''like urllib.request.urlopen, following redirects and raising HTTPError on 4xx/5xx
+'''
+        for i in range(self.max_redirects + 1):
+            parts = urllib.parse.urlsplit(url)
+            key = (parts.scheme, parts.hostname, 
+                   parts.port or (443 if parts.scheme == 'https' else 80))
+            path = (parts.path or '/') + ('?' + parts.query if parts.query else '')
+            while True:
+                conn, reused = self.__acquire__(key)
+                try:
+                    conn.request(method, path, headers = headers or {})
+                    resp = conn.getresponse()
+                    break
+                except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                    conn.close()
+                    if not reused: # idle connections may have been closed by the server
+                        raise
+                except:
+                    conn.close()
+                    raise
+            response = PooledResponse(self, key, conn, resp, url)
+            if resp.status in (301, 302, 303, 307, 308) and resp.headers.get('Location'):
+                response.read()
+                url = urllib.parse.urljoin(url, resp.headers['Location'])
+            elif resp.status >= 400:
+                response.read()
+                raise urllib.error.HTTPError(url, resp.status, resp.reason, resp.headers, None)
+            else:
+                return response
+        raise urllib.error.HTTPError(url, resp.status, 'Too many redirects', resp.headers, None)
+
+HTTP_POOL = HTTPConnectionPool()
+
+
+CACHE_DIR = 'cache' # fetched listing and book pages
+
+class PageCache(object):
+    '''content-addressed cache of fetched html: bodies are stored gzipped under their SHA-256,
+an index maps each url to its body with the ETag / Last-Modified to revalidate with.
+Opened lazily, disabled if dirname is None.
+'''
+    def __init__(self, dirname = CACHE_DIR, offline = False):
+        self.dirname = dirname
+        self.offline = offline # serve from the cache only, never touch the network
+        self.conn = None
+        self.lock = Lock()
+
+    def relocate(self, dirname):
+        # the cache in dirname from now on, the index of the previous one closed
+        with self.lock:
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+            self.dirname = dirname
+
+    def __connect__(self):
+        if self.conn is None:
+            os.makedirs(os.path.join(self.dirname, 'objects'), exist_ok = True)
+            self.conn = sqlite3.connect(os.path.join(self.dirname, 'index.sqlite'), 
+                                        timeout = 60, check_same_thread = False)
+            self.conn.execute('''CREATE TABLE IF NOT EXISTS pages (
+                                 url TEXT PRIMARY KEY, sha256 TEXT, etag TEXT, 
+                                 last_modified TEXT, fetched REAL)''')
+            self.conn.commit()
+        return self.conn
+
+    def __object_path__(self, sha256):
+        return os.path.join(self.dirname, 'objects', sha256[ : 2], sha256)
+
+    def get(self, url):
+        '''(body, etag, last_modified) of a cached url, or None
+'''
+        if not self.dirname:
+            return None
+        with self.lock:
+            row = self.__connect__().execute('SELECT sha256, etag, last_modified FROM pages '
+                                             'WHERE url = ?', (url, )).fetchone()
+        if not row:
+            return None
+        try:
+            with gzip.open(self.__object_path__(row[0]), 'rb') as f:
+                return f.read(), row[1], row[2]
+        except OSError: # object lost, fetch again
+            return None
+
+    def put(self, url, body, etag = None, last_modified = None):
+        if not self.dirname:
+            return
+        sha256 = hashlib.sha256(body).hexdigest()
+        path = self.__object_path__(sha256)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok = True)
+            part = PART_PATH(path)
+            with gzip.open(part, 'wb') as f:
+                f.write(body)
+            os.replace(part, path)
+        with self.lock:
+            self.__connect__().execute('INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?)', 
+                                       (url, sha256, etag, last_modified, time()))
+            self.conn.commit()
+
+    def urls(self):
+        if not self.dirname:
+            return []
+        with self.lock:
+            return [row[0] for row in self.__connect__().execute('SELECT url FROM pages ORDER BY url')]
+
+PAGE_CACHE = PageCache()
+
+ARCHIVE_PATH = 'crawl.warc.gz' # every listing and book page fetched, None for no archive
+INDEX_SUFFIX = '.cdx' # the offset index next to an archive, i.e. '<archive>.cdx'
+
+class CrawlArchive(object):
+    '''an append-only archive of the listing and book pages fetched, one WARC response record
+(status line, headers and body) per gzip member, so it is readable by WARC tools and any 
+record can be read alone. An index next to it maps each url to the offset and length of 
+its latest record; it is brought up to date from the archive when opened, e.g. after a 
+crash, and a torn record at the end is cut off.
+replaying, LinkProducer reads pages from the archives only, see AllITeBooksCrawler(replay)
+'''
+    def __init__(self, path = ARCHIVE_PATH):
+        self.path = path
+        self.replaying = False
+        self.index = {} # url -> (path, offset, length), of the archives replayed
+        self.file = None # opened on the first record
+        self.index_file = None
+        self.readers = {} # path -> file
+        self.lock = Lock()
+
+    def __scan__(self, path, offset, index):
+        '''index the records of path from offset on, return the offset after the last whole one
+'''
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            data = b''
+            while True:
+                member = zlib.decompressobj(31) # a gzip member
+                chunks, length = [], 0
+                while not member.eof:
+                    if not data:
+                        data = f.read(CHUNK_SIZE)
+                        if not data: # the end of the file, or a torn record
+                            return offset
+                    try:
+                        chunks.append(member.decompress(data))
+                    except zlib.error: # garbage after a crash
+                        return offset
+                    length += len(data) - len(member.unused_data)
+                    data = member.unused_data
+                url, status = self.__headers__(b''.join(chunks))[ : 2]
+                index.append((offset, length, status, url))
+                offset += length
+
+    def __headers__(self, record):
+        # (url, HTTP status, HTTP headers, body) of a WARC record
+        warc, _, payload = record.partition(b'\r\n\r\n')
+        url = re.search(rb'^WARC-Target-URI: (.*)$', warc, re.M).group(1).strip().decode('utf-8')
+        length = int(re.search(rb'^Content-Length: (\d+)', warc, re.M).group(1))
+        head, _, body = payload[ : length].partition(b'\r\n\r\n')
+        lines = head.decode('iso-8859-1').split('\r\n')
+        status = int(lines[0].split()[1])
+        headers = dict(line.split(': ', 1) for line in lines[1 : ] if ': ' in line)
+        return url, status, headers, body
+
+    def __open_index__(self, path):
+        '''[(offset, length, status, url), ...] of path, the index file updated if behind
+'''
+        index, end = [], 0
+        if os.path.exists(path + INDEX_SUFFIX):
+            with open(path + INDEX_SUFFIX, encoding = 'utf-8') as f:
+                for line in f:
+                    offset, length, status, url = line.rstrip('\n').split(' ', 3)
+                    index.append((int(offset), int(length), int(status), url))
+            end = index[-1][0] + index[-1][1] if index else 0
+        size = os.path.getsize(path) if os.path.exists(path) else 0
+        if end > size: # the index of another archive, rebuild it
+            index, end = [], 0
+        if end < size:
+            entries = []
+            good = self.__scan__(path, end, entries)
+            if good < size:
+                print('cutting off a torn record at %d bytes of %s' % (good, path))
+                os.truncate(path, good)
+            with open(path + INDEX_SUFFIX, 'at' if index else 'wt', encoding = 'utf-8') as f:
+                f.writelines('%d %d %d %s\n' % entry for entry in entries)
+            index += entries
+        return index
+
+    def record(self, url, status, headers, body):
+        # append a response, the archive is opened and checked on the first one
+        if not self.path or self.replaying:
+            return
+        head = 'HTTP/1.1 %d %s\r\n%s\r\n' % (status, http.client.responses.get(status, ''), 
+                                             ''.join('%s: %s\r\n' % item for item in headers.items()))
+        payload = head.encode('iso-8859-1', errors = 'replace') + body
+        warc = ('WARC/1.0\r\nWARC-Type: response\r\nWARC-Target-URI: %s\r\nWARC-Date: %s\r\n'
+                'WARC-Record-ID: <urn:sha256:%s>\r\nContent-Type: application/http; msgtype=response\r\n'
+                'Content-Length: %d\r\n\r\n' % (url, strftime('%Y-%m-%dT%H:%M:%SZ', gmtime()), 
+                                              hashlib.sha256(payload).hexdigest(), len(payload)))
+        member = gzip.compress(warc.encode('utf-8') + payload + b'\r\n\r\n')
+        with self.lock:
+            if self.file is None:
+                self.__open_index__(self.path)
+                self.file = open(self.path, 'ab')
+                self.index_file = open(self.path + INDEX_SUFFIX, 'at', encoding = 'utf-8')
+            offset = self.file.tell()
+            self.file.write(member)
+            self.file.flush() #the record first, then its index entry
+            self.index_file.write('%d %d %d %s\n' % (offset, len(member), status, url))
+            self.index_file.flush()
+
+    def replay(self, paths):
+        '''serve pages from archives instead of the network, paths, an archive, a pattern of 
+them like '*.crawl.warc.gz' or [archive, ...], later records of a url taking the place of 
+earlier ones
+'''
+        self.close()
+        self.index = {}
+        for path in sorted(glob.glob(paths)) if isinstance(paths, str) else paths:
+            for offset, length, status, url in self.__open_index__(path):
+                self.index[url] = (path, offset, length)
+        self.replaying = True
+        print('replaying %d pages from %s' % (len(self.index), paths))
+
+    def get(self, url):
+        '''(status, headers, body) of the latest record of url, or None
+'''
+        found = self.index.get(url)
+        if not found:
+            return None
+        path, offset, length = found
+        with self.lock:
+            if path not in self.readers:
+                self.readers[path] = open(path, 'rb')
+            reader = self.readers[path]
+            reader.seek(offset)
+            member = reader.read(length)
+        return self.__headers__(gzip.decompress(member))[1 : ]
+
+    def urls(self):
+        return sorted(self.index)
+
+    def close(self):
+        with self.lock:
+            for f in [self.file, self.index_file] + list(self.readers.values()):
+                if f:
+                    f.close()
+            self.file = self.index_file = None
+            self.readers = {}
+
+ARCHIVE = CrawlArchive()
+
+BLOB_DIRNAME = '.blobs' # content-addressed store of downloaded books, under book_dirname
+
+class BlobStore(object):
+    '''downloaded books kept once by SHA-256, as <dirname>/<sha256[:2]>/<sha256>, and hard-linked
+to the names seen in book_dirname. index.jsonl holds one record per blob, {'sha256', 'size', 
+'ext', 'links', 'ETag', 'Last-Modified'}, to recognise an upstream file before downloading it.
+The index is loaded on the first access.
+'''
+    LAZY = ('records', 'by_etag', 'by_size')
+
+    def __init__(self, dirname = os.path.join('books', BLOB_DIRNAME)):
+        self.dirname = dirname
+        self.lock = RLock()
+
+    def relocate(self, dirname):
+        # the blobs in dirname from now on, the index of the previous ones loaded again if used
+        with self.lock:
+            for name in BlobStore.LAZY:
+                self.__dict__.pop(name, None)
+            self.dirname = dirname
+
+    def __getattr__(self, name): # called until the index is loaded only
+        if name not in BlobStore.LAZY:
+            raise AttributeError(name)
+        self.load()
+        return self.__dict__[name]
+
+    def load(self):
+        with self.lock:
+            if 'records' in self.__dict__:
+                return
+            records = {} # sha256 -> record
+            path = os.path.join(self.dirname, 'index.jsonl')
+            if os.path.exists(path):
+                with open(path, encoding = 'utf-8') as f:
+                    for line in f:
+                        try:
+                            record = json.loads(line)
+                        except ValueError: # torn last line
+                            continue
+                        if record.get('removed'):
+                            records.pop(record['sha256'], None)
+                        else:
+                            records[record['sha256']] = record
+            self.__reindex__(records)
+
+    def __reindex__(self, records):
+        self.by_etag = {} # strong ETag -> sha256
+        self.by_size = {} # (ext, size) -> [sha256, ...]
+        for record in records.values():
+            self.__index__(record)
+        self.records = records
+
+    def __index__(self, record):
+        if record.get('ETag') and not record['ETag'].startswith('W/'):
+            self.by_etag[record['ETag']] = record['sha256']
+        digests = self.by_size.setdefault((record['ext'], record['size']), [])
+        if record['sha256'] not in digests:
+            digests.append(record['sha256'])
+
+    def __append__(self, record):
+        with open(os.path.join(self.dirname, 'index.jsonl'), 'at', encoding = 'utf-8') as f:
+            f.write(json.dumps(record, ensure_ascii = False) + '\n')
+
+    def path_of(self, digest):
+        return os.path.join(self.dirname, digest[ : 2], digest)
+
+    def match(self, ext, size, link, etag = None, last_modified = None):
+        '''sha256 of the blob an upstream file is, judged from its response headers, or None.
+A strong ETag identifies a file, its size only along with the same link or Last-Modified,
+as sizes alone collide among thousands of books.
+'''
+        with self.lock:
+            digest = self.by_etag.get(etag) if etag else None
+            if digest and size and self.records[digest]['size'] != size:
+                digest = None
+            if digest is None and size:
+                for candidate in self.by_size.get((ext, size), []):
+                    record = self.records[candidate]
+                    if link in record['links'] or (
+                            last_modified and record.get('Last-Modified') == last_modified):
+                        digest = candidate
+                        break
+            if digest and os.path.exists(self.path_of(digest)):
+                return digest
+        return None
+
+    def add(self, filepath, digest, ext, link, etag = None, last_modified = None):
+        # move a downloaded file into the store, filepath becomes a link to the blob
+        blob = self.path_of(digest)
+        with self.lock:
+            if os.path.exists(blob): # the same book under another name
+                os.remove(filepath)
+            else:
+                if not os.path.exists(os.path.dirname(blob)):
+                    os.makedirs(os.path.dirname(blob))
+                os.replace(filepath, blob)
+            known = self.records.get(digest, {'links' : []})
+            record = {'sha256' : digest, 'size' : os.path.getsize(blob), 'ext' : ext, 
+                      'links' : known['links'] + [link] if link not in known['links'] else known['links'], 
+                      'ETag' : etag or known.get('ETag'), 
+                      'Last-Modified' : last_modified or known.get('Last-Modified')}
+            self.records[digest] = record
+            self.__index__(record)
+            self.__append__(record)
+            self.link(digest, filepath)
+
+    def link(self, digest, filepath):
+        # hard link a blob to filepath, or copy it where hard links are not supported
+        if os.path.exists(filepath):
+            os.remove(filepath)
+        try:
+            os.link(self.path_of(digest), filepath)
+        except OSError:
+            copyfile(self.path_of(digest), filepath)
+
+    def discard(self, digest):
+        # forget a corrupt blob, the names linked to it are left as they are
+        with self.lock:
+            if digest not in self.records:
+                return
+            if os.path.exists(self.path_of(digest)):
+                os.remove(self.path_of(digest))
+            self.records.pop(digest)
+            self.__reindex__(self.records)
+            self.__append__({'sha256' : digest, 'removed' : True})
+
+BLOB_STORE = BlobStore()
+
 class firstParser(html.parser.HTMLParser):
     '''parse links like "http://www.allitebooks.com/page/2/"
-get page link
+get page link, and the last page number from the pagination
 '''
     def __init__(self):
         self.anchorlist = []
+        self.last_page = 0 #the highest page number linked, or shown like "1 / 800 Pages"
         super().__init__()
 
     def __find_Anchorlist__(self, attrs):
@@ -131,6 +1744,10 @@ get page link
         if attrs.get('rel') == 'bookmark':
             if attrs.get('href') not in self.anchorlist:
                 self.anchorlist.append(attrs['href'])
+        elif attrs.get('href'):
+            page = PAGE_LINK.search(attrs['href'])
+            if page:
+                self.last_page = max(self.last_page, int(page.group(1)))
         
     def handle_startendtag(self, tag, attrs):
         self.__find_Anchorlist__(attrs)
@@ -138,23 +1755,69 @@ get page link
     def handle_starttag(self, tag, attrs):
         self.__find_Anchorlist__(attrs)
 
+    def handle_data(self, data):
+        pages = PAGE_COUNT.search(data)
+        if pages:
+            self.last_page = max(self.last_page, int(pages.group(1)))
+
+class Anchor(namedtuple('Anchor', 'name url ext size year', defaults = (None, None))):
+    '''a file to download: book name, .pdf / .epub link, 'pdf' / 'epub', and the 'File size' in
+bytes and the year of the book if known, for DownloadScheduler
+'''
+    __slots__ = ()
+
+    @property
+    def file(self):
+        return '%s.%s' % (self.name, self.ext)
+
+FILE_SIZE = re.compile(r'([\d.]+)\s*([KMG]?B)', re.I) # 'File size' of a book page, e.g. '4.5 MB'
+SIZE_UNITS = {'B' : 1, 'KB' : 2 ** 10, 'MB' : 2 ** 20, 'GB' : 2 ** 30}
+
+def FILE_BYTES(size):
+    # 'File size' of a book page in bytes, or None
+    match = FILE_SIZE.search(size) if isinstance(size, str) else None
+    if not match:
+        return None
+    try:
+        return int(float(match.group(1)) * SIZE_UNITS[match.group(2).upper()])
+    except ValueError: # e.g. '1.2.3 MB'
+        return None
+
+class BookRecord(object):
+    '''a parsed book page, lean enough to be created per page and sent between processes
+name, book name, the index of the catalog
+fields, {column : value} of the catalog row, i.e. links and dt/dd metadata
+categories, [category, ...]
+description, lines of 'Book Description'
+anchors, [Anchor, ...]
+'''
+    __slots__ = ('name', 'fields', 'categories', 'description', 'anchors')
+
+    def __init__(self, link):
+        self.name = None
+        self.fields = {'link-bookpage' : link, 'downloaded (PDF)?' : False, 'downloaded (ePub)?' : False, 
+                       'Book Description' : ''}
+        self.categories = []
+        self.description = []
+        self.anchors = []
+
+    def to_dict(self):
+        row = dict(self.fields)
+        row['Book Description'] = ''.join(line + '\n' for line in self.description)
+        return row
+
 class secondParser(html.parser.HTMLParser):
     '''parse links like "http://www.allitebooks.com/elixir-in-action-2nd-edition/"
-get the real book link, and log it in a pandas.Series instance
+get the real book link, and log it in a BookRecord instance
 '''
     def __init__(self, link):
-        self.anchor = [] #may be both .pdf and .epub links
         self.in_dt = False
         self.in_dd = False
         self.in_book_description = False
         self.title = None
-        self.content = None
-        self.data = pandas.Series()
+        self.data = BookRecord(link)
         self.common_bookname = None #temp storage for book name shared between 2 anchors(pdf, epub)
-        self.data['link-bookpage'] = link
-        self.data['downloaded (PDF)?'] = False
-        self.data['downloaded (ePub)?'] = False
-        self.data['Book Description'] = ''
+        self.bookpage_slug = os.path.split(link.strip('/'))[1]
         super().__init__()
 
     def __find_Anchor__(self, attrs):
@@ -162,20 +1825,17 @@ get the real book link, and log it in a pandas.Series instance
         global FORMAT_TO_LINK, FORMAT_TO_FILENAME
         attrs = dict(attrs)
         if attrs.get('target') == '_blank':
+            href = attrs['href']
             for ext in ('pdf', 'epub'):
-                if attrs['href'].endswith(ext):
-                    self.data['link-%s' % ext] = attrs['href']
-                    if FORMAT_TO_LINK(os.path.splitext(os.path.split(attrs['href'])[1])[0]) \
-                            not in self.data['link-bookpage']:
-                        book_name = '.'.join(
-                                [FORMAT_TO_FILENAME(os.path.split(self.data['link-bookpage'].strip('/'))[1]), 
-                                 ext])
+                if href.endswith(ext):
+                    self.data.fields['link-%s' % ext] = href
+                    file_name = os.path.splitext(os.path.split(href)[1])[0]
+                    if FORMAT_TO_LINK(file_name) not in self.data.fields['link-bookpage']:
+                        book_name = FORMAT_TO_FILENAME(self.bookpage_slug)
                     else:
-                        book_name = os.path.split(attrs['href'])[1]
-                        self.common_bookname = os.path.splitext(book_name)[0]
+                        book_name = self.common_bookname = file_name
                         self.data.name = self.common_bookname #use book name as the index of DataFrame rows.
-                    book_link = '&&&'.join([book_name, attrs['href']])
-                    self.anchor.append(book_link) #format: "name&&&link"
+                    self.data.anchors.append(Anchor(book_name, href, ext))
         
     def handle_startendtag(self, tag, attrs):
         self.__find_Anchor__(attrs)
@@ -204,256 +1864,521 @@ get the real book link, and log it in a pandas.Series instance
             self.title = data.strip(':')
         elif self.in_dd and data.strip():
             if self.title != 'Category':
-                self.data[self.title] = data.strip()
+                self.data.fields[self.title] = data.strip()
             else:
-                self.data['CATG***' + data.strip()] = True #book categories
+                self.data.categories.append(data.strip())
         elif self.in_book_description:
             if data.strip() and (data.strip(':') != 'Book Description'):
-                self.data['Book Description'] += (data.strip() + '\n')
+                self.data.description.append(data.strip())
 
     def close(self):
-        if self.common_bookname:
-            for i in range(len(self.anchor)):
-                self.anchor[i] = self.common_bookname + \
-                    os.path.splitext(self.anchor[i].split('&&&')[0])[1] + \
-                    '&&&' + self.anchor[i].split('&&&')[1]
+        super().close()
+        anchors = self.data.anchors
+        fields = self.data.fields
+        anchors[ : ] = [anchor._replace(name = self.common_bookname or anchor.name, 
+                                        size = FILE_BYTES(fields.get('File size')), 
+                                        year = NORMALIZE_YEAR(fields.get('Year'))) for anchor in anchors]
         #finally ,if anchor exists, but no anchor with book_name same as the parent link.
-        if (not self.data.name) and self.anchor: 
-            self.data.name = os.path.splitext(self.anchor[0].split('&&&')[0])[0] 
+        if (not self.data.name) and anchors: 
+            self.data.name = anchors[0].name
+
+PARSE_WORKERS = None # processes reparsing cached book pages, None for the CPU count, 0 for none
+
+def PARSE_BOOKPAGE(item):
+    # (url, html bytes) -> BookRecord, run in worker processes by reparse_Cache
+    url, content = item
+    parser_2 = secondParser(url)
+    parser_2.feed(content.decode(encoding = 'utf-8', errors = 'ignore'))
+    parser_2.close()
+    return parser_2.data
 
 class LinkProducer(Thread):
     '''a producer, which generates real .pdf link to be dowloaded, and puts it into queue.
 '''
-    link_count = 0
+    link_count = AtomicCounter()
     
     def __init__(self, headers, queue, parallels, lock, 
-                 name = 'LinkProducer', updating = False, start_page = None):
+                 name = 'LinkProducer', updating = False, start_page = None, concurrency = None, 
+                 base_url = BASE_URL):
         super().__init__(name = name)
-        self.base_url = 'http://www.allitebooks.com/page'
+        self.base_url = base_url.rstrip('/') + '/page'
         self.headers = headers
         self.pdf_links = queue
         self.parallels = parallels
         self.lock = lock
         self.updating = updating
         self.start_page = start_page
+        self.concurrency = dict(CONCURRENCY, **(concurrency or {}))
+        self.last_page = 0 #the last listing page known from pagination links
+        self.listings = {} #listing pages fetched while probing, page -> anchorlist
+        self.planned = [] #book pages to revisit, planned by __check_DB__
+        self.bookpage_pool = None #parse book pages concurrently
 
     def __check_DB__(self):
-        '''check database (loaded from allitebooks.xlsx) before parsing
+        '''plan the book pages to revisit, in one pass over the columns of the database
+(loaded from allitebooks.xlsx): missing format, PDF not downloaded, ePub not downloaded,
+minus the links known to fail. Return {kind : [book page link, ...]}
 '''
-        global DB, BUG_FILE, FORMAT_TO_LINK
+        global CATALOG, ERROR_JOURNAL, FORMAT_TO_LINK
         print('checking database...')
-        with open(BUG_FILE) as f:
-            err_log = f.read()
-        for bookname in DB.index:
-            if not DB.loc[bookname, 'File format']:
-                s = FORMAT_TO_LINK(bookname)
-                link = '/'.join([self.base_url, s])
-                if link not in err_log:
-                    self.__parse_link__(link)
-            elif ('pdf' in DB.loc[bookname, 'File format'].lower()) and \
-               (not DB.loc[bookname, 'downloaded (PDF)?']):
-                if DB.loc[bookname, 'link-pdf'] not in err_log:
-                    self.__parse_link__(DB.loc[bookname, 'link-bookpage'])
-            elif ('epub' in DB.loc[bookname, 'File format'].lower()) and \
-               (not DB.loc[bookname, 'downloaded (ePub)?']):
-                if DB.loc[bookname, 'link-epub'] not in err_log:
-                    self.__parse_link__(DB.loc[bookname, 'link-bookpage'])
-        print('database checked.\n', '=' * 80)                
+        started = time()
+        DB = CATALOG.db
+        plan = {'missing format' : [], 'PDF not downloaded' : [], 'ePub not downloaded' : []}
+        if DB.empty:
+            return plan
+        def column(name, default):
+            if name in DB.columns:
+                return DB[name]
+            return pandas.Series(default, index = DB.index, dtype = object)
+        file_format = column('File format', '').fillna('').astype(str).str.lower()
+        bookpages = column('link-bookpage', nan)
+        known_errors = [record['url'] for record in ERROR_JOURNAL.values()]
+        no_format = file_format == ''
+        if (no_format & bookpages.isnull()).any(): #guess book pages of rows without one
+            guessed = pandas.Series(DB.index[no_format & bookpages.isnull()], 
+                                    index = DB.index[no_format & bookpages.isnull()])
+            bookpages = bookpages.fillna(guessed.map(
+                lambda name : '/'.join([self.base_url, FORMAT_TO_LINK(name)])))
+        no_pdf = ~no_format & file_format.str.contains('pdf') & \
+            ~column('downloaded (PDF)?', False).fillna(False).astype(bool)
+        no_epub = ~no_format & ~no_pdf & file_format.str.contains('epub') & \
+            ~column('downloaded (ePub)?', False).fillna(False).astype(bool)
+        masks = {'missing format' : no_format & ~bookpages.isin(known_errors), 
+                 'PDF not downloaded' : no_pdf & ~column('link-pdf', nan).isin(known_errors), 
+                 'ePub not downloaded' : no_epub & ~column('link-epub', nan).isin(known_errors)}
+        for kind, mask in masks.items():
+            plan[kind] = list(bookpages[mask & bookpages.notnull()])
+        print('database checked in %.3fs, scheduled: %s\n' % (time() - started, 
+              ', '.join('%d %s' % (len(links), kind) for kind, links in plan.items())), '=' * 80)
+        return plan
     
-    def __parse_link__(self, link): #generate real book .pdf link
-        '''link, links like "http://www.allitebooks.com/elixir-in-action-2nd-edition/"
+    def __fetch_page__(self, url, kind = 'bookpage'):
+        '''fetch a listing page or a book page, retrying on time-outs, return the html
+kind, request class of RATE_LIMITER, 'listing' or 'bookpage'
+pages are revalidated against PAGE_CACHE, and served from it only if offline, 
+or from ARCHIVE only if replaying
 '''
-        global DB, BUG_FILE, ERROR_COUNT
+        retval = None
+        if ARCHIVE.replaying:
+            archived = ARCHIVE.get(url)
+            if not archived or archived[0] != 200:
+                raise urllib.error.HTTPError(url, archived[0] if archived else 404, 
+                                             'Not Found (replay)', {}, None)
+            return archived[2].decode(encoding = 'utf-8', errors = 'ignore')
+        cached = PAGE_CACHE.get(url)
+        if PAGE_CACHE.offline:
+            if not cached:
+                raise urllib.error.HTTPError(url, 404, 'Not Found (offline)', {}, None)
+            return cached[0].decode(encoding = 'utf-8', errors = 'ignore')
+        headers = dict(self.headers)
+        if cached:
+            if cached[1]:
+                headers['If-None-Match'] = cached[1]
+            if cached[2]:
+                headers['If-Modified-Since'] = cached[2]
         while True:
             try:
-                req_2 = urllib.request.Request(link, headers=self.headers)
-                retval_2 = urllib.request.urlopen(req_2)
-                parser_2 = secondParser(link)
-                parser_2.feed(retval_2.read().decode(encoding='utf-8', errors='ignore'))
-                parser_2.close()
-                retval_2.close() #close response timely
-                break
+                RATE_LIMITER.acquire(kind)
+                retval = HTTP_POOL.urlopen(url, headers)
+                body = retval.read()
+                retval.close() #close response timely
+                RATE_LIMITER.success(kind)
+                if cached and retval.status == 304: #not modified
+                    body = cached[0]
+                else:
+                    PAGE_CACHE.put(url, body, retval.headers.get('ETag'), 
+                                   retval.headers.get('Last-Modified'))
+                ARCHIVE.record(url, 200, retval.headers, body)
+                return body.decode(encoding = 'utf-8', errors = 'ignore')
             except (ConnectionResetError, TimeoutError) as e:
-                print('\n************************%s: %s\n\sleep a while and restart parsing...\n'
-                      % (link, e))
+                print('\n************************%s: %s\nsleep a while and restart parsing...\n'
+                      % (url, e))
                 try:
-                    retval_2.close() #close response timely, if necessary
+                    retval.close() #close response timely, if necessary
                 except:
                     pass
-                sleep(3) #pause for each page processing, if Exception happens.
+                sleep(RATE_LIMITER.failure(kind, e)) #back off, if Exception happens.
             except Exception as e:
-                if ('timed out' in str(e)) or ('[Errno 11004] getaddrinfo failed' in str(e)):
+                if ('timed out' in str(e)) or ('[Errno 11004] getaddrinfo failed' in str(e)) or \
+                   IS_THROTTLED(e):
                     print('\n************************%s: %s\nsleep a while and restart parsing...\n' 
-                          % (link, e))
+                          % (url, e))
                     try:
-                        retval_2.close() #close response timely, if necessary
+                        retval.close() #close response timely, if necessary
                     except:
                         pass
-                    sleep(3) #pause for each page processing, if Exception happens.
+                    sleep(RATE_LIMITER.failure(kind, e)) #back off, if Exception happens.
                 else:
+                    try:
+                        retval.close() #close response timely, if necessary
+                    except:
+                        pass
                     raise
-        #logging info
-        if self.lock.acquire():
-            if not parser_2.anchor: # in case no links retrieved by parser_2
-                ERROR_COUNT += 1
-                msg = '\n(ERROR-%d) %s************************No pdf/epub anchor for [%s]\n' % (
-                        ERROR_COUNT, ctime(), link)
-                print(msg)
-                with open(BUG_FILE, 'at') as f:
-                    f.write(msg)
+
+    def __fetch_listing__(self, page):
+        '''book page links on a listing page, raise when there is no such page
+'''
+        with METRICS.timed('listing fetch'):
+            content = self.__fetch_page__('/'.join([self.base_url, str(page)]), 'listing')
+        with METRICS.timed('parse'):
+            parser_1 = firstParser()
+            parser_1.feed(content)
+            parser_1.close()
+        self.last_page = max(self.last_page, parser_1.last_page)
+        return parser_1.anchorlist
+
+    def __probe__(self, page):
+        '''whether a listing page exists, keeping its links for later
+'''
+        try:
+            self.listings[page] = self.__fetch_listing__(page)
+            return True
+        except urllib.error.HTTPError:
+            return False
+        except Exception as e: # e.g. the site unreachable, taken as the end of the listing
+            print('\n************************Page-%d: %s' % (page, e))
+            return False
+
+    def __find_last_page__(self, page):
+        '''the last listing page, from the pagination links of the first page, otherwise by
+exponential and then binary probing
+'''
+        if not self.__probe__(page):
+            return page - 1
+        if self.last_page >= page:
+            return self.last_page
+        low, high = page, page * 2 #low exists
+        while self.__probe__(high):
+            low, high = high, high * 2
+        while high - low > 1:
+            middle = (low + high) // 2
+            if self.__probe__(middle):
+                low = middle
             else:
-                if parser_2.data.name not in DB.index:
-                    DB = DB.append(parser_2.data)
-                else:
-                    DB.loc[parser_2.data.name] = parser_2.data
-            self.lock.release()
+                high = middle
+        return low
+
+    def __parse_link__(self, link): #generate real book .pdf link
+        '''link, links like "http://www.allitebooks.com/elixir-in-action-2nd-edition/"
+'''
+        with METRICS.timed('bookpage fetch'):
+            content = self.__fetch_page__(link, 'bookpage')
+        with METRICS.timed('parse'):
+            parser_2 = secondParser(link)
+            parser_2.feed(content)
+            parser_2.close()
+        self.__record__(link, parser_2.data)
         #put .pdf link into queue
-        for file_link in parser_2.anchor:
-            self.pdf_links.put(file_link)
-            self.__class__.link_count += 1
+        if PAGE_CACHE.offline: #nothing to download
+            return
+        for anchor in parser_2.data.anchors:
+            self.pdf_links.put(anchor)
             print('~~link-%d~~ %s >> [%s] downloading...' 
-                  % (self.__class__.link_count, ctime(), file_link.split('&&&')[0]))
+                  % (self.__class__.link_count.increment(), ctime(), anchor.file))
 
-    def run(self):
-        '''get book links
+    def __record__(self, link, book):
+        '''update the catalog with a parsed book page, or log it if no anchor found
+'''
+        global CATALOG_WRITER, ERROR_JOURNAL, ERROR_COUNT
+        #logging info
+        if not book.anchors: # in case no links retrieved by secondParser
+            msg = '\n(ERROR-%d) %s************************No pdf/epub anchor for [%s]\n' % (
+                    ERROR_COUNT.increment(), ctime(), link)
+            print(msg)
+            ERROR_JOURNAL.record(link, 'bookpage', 'No pdf/epub anchor', 'NoAnchor')
+        else:
+            ERROR_JOURNAL.resolve(link)
+            CATALOG_WRITER.add(book.name, book.to_dict(), book.categories)
+
+    def __is_new__(self, link):
+        # whether to parse a book page, all of them when reparsing pages offline
+        global CATALOG
+        return PAGE_CACHE.offline or link not in CATALOG.index
+
+    def __first_page__(self):
+        '''the listing page to start from, check database first if it is the first running
 '''
-        global START_PAGE_FILE, DB, DB_PATH
+        global START_PAGE_FILE
         if self.start_page:
-            page = self.start_page
+            return self.start_page
+        elif PAGE_CACHE.offline: #all pages again, the checkpoint is of crawling
+            print('reparsing all pages @ %s' % ctime())
+            return 1
         elif self.updating:
             print('regular updating @ %s' % ctime())
-            page = 1
-        else:
-            print('first time running @ %s' % ctime())
-            self.__check_DB__() # DB check first
-            if os.path.exists(START_PAGE_FILE):
-                with open(START_PAGE_FILE, 'rt') as f:
-                    page = int(f.read())
-            else:
-                page = 1
-        all_downloaded = False
-        while not all_downloaded:
-            print('\n\n%sProcessing Page-%d%s\n' % ('+' * 30, page, '+' * 30))
-            try:
-                url = '/'.join([self.base_url, str(page)])
-                req_1 = urllib.request.Request(url, headers = self.headers)
-                retval_1 = urllib.request.urlopen(req_1)
-                parser_1 = firstParser()
-                parser_1.feed(retval_1.read().decode(encoding = 'utf-8', errors = 'ignore'))
-                parser_1.close()
-                retval_1.close() #close response timely, if necessary
-                updated = False
-                for link in parser_1.anchorlist:
-                    if 'link-bookpage' not in DB.columns:
-                        self.__parse_link__(link)
-                        updated = True
-                    elif link not in list(DB['link-bookpage']): #'list' should be used here
-                        self.__parse_link__(link)
-                        updated = True
+            return 1
+        print('first time running @ %s' % ctime())
+        for links in self.__check_DB__().values(): # DB check first, parsed concurrently later on
+            self.planned.extend(links)
+        if os.path.exists(START_PAGE_FILE):
+            with open(START_PAGE_FILE, 'rt') as f:
+                return int(f.read())
+        return 1
+
+    def __page_done__(self, page, updated):
+        '''persist changed rows and the checkpoint after a listing page, return the next page
+'''
+        global START_PAGE_FILE
+        if updated:
+            CATALOG_WRITER.flush() #persist changed rows only, before the checkpoint
+        page += 1
+        if not (self.updating or PAGE_CACHE.offline):
+            with open(START_PAGE_FILE, 'wt') as f:
+                f.write(str(page))
+        return page
+
+    def __parse_links__(self, links):
+        '''parse book pages concurrently, within the 'bookpage' concurrency, until all done
+'''
+        for future in [self.bookpage_pool.submit(self.__parse_link__, link) for link in links]:
+            future.result()
+
+    def __run_parallel__(self, page):
+        '''fetch all listing pages from page on concurrently, within the 'listing' concurrency
+and rate budget, while book pages are parsed in page order to keep the checkpoint
+'''
+        global CATALOG
+        last = self.__find_last_page__(page)
+        print('%d listing pages to parse (%d~%d).' % (last - page + 1, page, last))
+        pool = ThreadPoolExecutor(max_workers = self.concurrency['listing'])
+        futures = {p : pool.submit(self.__fetch_listing__, p) 
+                   for p in range(page, last + 1) if p not in self.listings}
+        try:
+            while page <= last:
+                print('\n\n%sProcessing Page-%d%s\n' % ('+' * 30, page, '+' * 30))
+                try:
+                    if page in self.listings:
+                        anchorlist = self.listings.pop(page)
                     else:
-                        #continue #first updating
-                        if self.updating and (not self.start_page): #regular updating
-                            all_downloaded = True
-                            break
-                if updated and self.lock.acquire():
-                    while True:
-                        try:
-                            DB.to_excel(DB_PATH)
-                            self.lock.release()
-                            break
-                        except:
-                            pass
-                page += 1
-                if not self.updating:
-                    with open(START_PAGE_FILE, 'wt') as f:
-                        f.write(str(page))
-                sleep(3) #regular pause after each page parsing.
-            except (ConnectionResetError, TimeoutError) as e:
-                print('\n************************%s: %s\nsleep a while and restart parsing...\n' 
-                      % (url, e))
+                        anchorlist = futures.pop(page).result()
+                    new_links = [link for link in anchorlist if self.__is_new__(link)]
+                    self.__parse_links__(new_links)
+                    page = self.__page_done__(page, bool(new_links))
+                except Exception as e:
+                    print('\n************************Page-%d: %s' % (page, e))
+                    break
+        finally:
+            for future in futures.values():
+                future.cancel()
+            pool.shutdown()
+        print('All pages (1~%d) have been parsed.' % (page - 1))
+
+    def run(self):
+        '''get book links
+'''
+        global CATALOG
+        self.bookpage_pool = ThreadPoolExecutor(max_workers = self.concurrency['bookpage'])
+        try:
+            page = self.__first_page__()
+            planned = [self.bookpage_pool.submit(self.__parse_link__, link) for link in self.planned]
+            if not self.updating: #first running, walk all listing pages
+                self.__run_parallel__(page)
+            all_downloaded = not self.updating
+            while not all_downloaded:
+                print('\n\n%sProcessing Page-%d%s\n' % ('+' * 30, page, '+' * 30))
+                url = '/'.join([self.base_url, str(page)])
                 try:
-                    retval_1.close() #close response timely, if necessary
-                except:
-                    pass
-                sleep(3) #pause for each page processing, if Exception happens.
-            except Exception as e:
-                if ('timed out' in str(e)) or ('[Errno 11004] getaddrinfo failed' in str(e)):
-                    print('\n************************%s: %s\nsleep a while and restart parsing...\n' 
-                          % (url, e))
-                    try:
-                        retval_1.close() #close response timely, if necessary
-                    except:
-                        pass
-                    sleep(3) #pause for each page processing, if Exception happens.
-                else:
+                    new_links = []
+                    for link in self.__fetch_listing__(page):
+                        if self.__is_new__(link):
+                            new_links.append(link)
+                        else:
+                            #continue #first updating
+                            if self.updating and (not self.start_page): #regular updating
+                                all_downloaded = True
+                                break
+                    self.__parse_links__(new_links)
+                    page = self.__page_done__(page, bool(new_links)) #pace is kept by RATE_LIMITER
+                except Exception as e:
                     print('\n************************%s: %s' % (url, e))
                     print('All pages (1~%d) have been parsed.' % (page - 1))
-                    try:
-                        retval_1.close() #close response timely, if necessary
-                    except:
-                        pass
                     all_downloaded = True
-                    break
-        for i in range(self.parallels): #produce signature to finish all downloaders.
-            self.pdf_links.put('finished')
+            for future in planned: #book pages planned by __check_DB__
+                try:
+                    future.result()
+                except Exception as e:
+                    print('\n************************%s' % e)
+            CATALOG_WRITER.flush() #persist rows left in the buffer
+        finally: #downloaders are never left waiting, whatever happened
+            self.bookpage_pool.shutdown()
+            for i in range(self.parallels): #produce signature to finish all downloaders.
+                self.pdf_links.put('finished')
     
 class Downloader(Thread):
     '''a consumer, which downloads file which linked to .pdf link from queue.
 '''
-    def __init__(self, headers, queue, book_dirname, lock, name = 'Downloader', err_links = False):
+    def __init__(self, headers, queue, book_dirname, lock, name = 'Downloader', err_links = False, 
+                 chunk_size = CHUNK_SIZE):
         super().__init__(name = name)
         self.headers = headers
         self.pdf_links = queue
         self.book_dirname = book_dirname
         self.lock = lock
         self.err_links = err_links # indicate error links downloader
+        self.chunk_size = chunk_size # bytes read and written at a time
+
+    def __load_resume__(self, partpath, link):
+        '''resume state of a partial file: (offset, {'link', 'total', 'ETag', 'Last-Modified'})
+'''
+        statepath = partpath + RESUME_SUFFIX
+        try:
+            with open(statepath) as f:
+                state = json.load(f)
+            if state.get('link') == link and os.path.exists(partpath):
+                return os.path.getsize(partpath), state
+        except (OSError, ValueError):
+            pass
+        return 0, {'link' : link}
+
+    def __save_resume__(self, partpath, state):
+        with open(partpath + RESUME_SUFFIX, 'wt') as f:
+            json.dump(state, f)
 
-    def __download_file__(self, file_link): #download single file
-        '''file_link, like "filename&&&link''
+    def __clear_resume__(self, partpath):
+        for path in (partpath, partpath + RESUME_SUFFIX):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def __open__(self, link, offset, state):
+        '''open the file link, asking for the bytes from offset on if there is a partial file
 '''
-        global DB, DB_PATH, DOWNLOADED_COUNT, BUG_FILE, ERROR_COUNT
-        if DOWNLOADED_COUNT % 100 == 0: #DEBUG-(1)
+        headers = dict(self.headers)
+        if offset:
+            headers['Range'] = 'bytes=%d-' % offset
+            validator = state.get('ETag')
+            if (not validator) or validator.startswith('W/'): #If-Range takes strong validators only
+                validator = state.get('Last-Modified')
+            if validator:
+                headers['If-Range'] = validator
+        try:
+            return HTTP_POOL.urlopen(link, headers)
+        except urllib.error.HTTPError as e:
+            if e.code == 416: # range not satisfiable, the caller restarts from zero
+                raise
+        except (http.client.InvalidURL, UnicodeEncodeError): # unquoted url
+            pass
+        alt_link = urllib.parse.quote(link, safe='/:') # handle "HTTP Error 400: Bad Request"
+        return HTTP_POOL.urlopen(alt_link, headers)
+
+    def __resumed_at__(self, retval, offset, state):
+        '''offset the response body starts at, 0 unless the server honoured the range request
+and the file is still the one the partial file was started with
+'''
+        if (not offset) or (retval.status != 206):
+            return 0
+        content_range = retval.headers.get('Content-Range', '') # "bytes 100-999/1000"
+        try:
+            start = int(content_range.split()[1].split('-')[0])
+            total = content_range.split('/')[1]
+        except (IndexError, ValueError):
+            return 0
+        if start != offset or (state.get('total') and total != '*' and int(total) != state['total']):
+            return 0
+        return offset
+
+    def __hash_part__(self, partpath, offset):
+        # SHA-256 of the first offset bytes of a partial file, continued while resuming
+        sha256 = hashlib.sha256()
+        if offset:
+            with open(partpath, 'rb') as f:
+                for chunk in iter(lambda : f.read(self.chunk_size), b''):
+                    sha256.update(chunk)
+        return sha256
+
+    def __stream__(self, retval, f, filename, offset = 0, sha256 = None):
+        '''copy the response to file f chunk by chunk, tracking progress in DOWNLOAD_PROGRESS
+and hashing the content into sha256
+'''
+        global DOWNLOAD_PROGRESS
+        total = retval.headers.get('Content-Length')
+        progress = {'bytes' : offset, 'total' : offset + int(total) if total else None, 'bytes/s' : 0.0}
+        DOWNLOAD_PROGRESS[filename] = progress
+        worker = current_thread().name # the Downloader, or a thread of another engine
+        started = time()
+        while True:
+            chunk = retval.read(self.chunk_size)
+            if not chunk:
+                break
+            f.write(chunk)
+            if sha256:
+                sha256.update(chunk)
+            progress['bytes'] += len(chunk)
+            METRICS.count('bytes downloaded', len(chunk), worker = worker)
+            progress['bytes/s'] = (progress['bytes'] - offset) / max(time() - started, 1e-6)
+            BANDWIDTH_LIMITER.acquire(len(chunk)) #shared by all downloads
+        elapsed = time() - started
+        METRICS.count('download seconds', elapsed, worker = worker)
+        if progress['total'] and progress['bytes'] < progress['total']:
+            raise http.client.IncompleteRead(b'', progress['total'] - progress['bytes'])
+        METRICS.observe('file download', elapsed)
+        METRICS.count('files downloaded', worker = worker)
+        return progress
+
+    def __download_file__(self, anchor): #download single file
+        '''anchor, Anchor(name, link, ext)
+'''
+        global DOWNLOADED_COUNT, DOWNLOAD_PROGRESS, ERROR_JOURNAL, ERROR_COUNT
+        if DOWNLOADED_COUNT.value % 100 == 0: #DEBUG-(1)
             temp_dir = os.path.join(r'C:\Windows\SysWOW64', self.book_dirname)
             if os.path.exists(temp_dir):
                 rmtree(temp_dir)
-        filename, link = file_link.split('&&&')
+        filename, link = anchor.file, anchor.url
         filepath = os.path.join(self.book_dirname, filename)
+        partpath = filepath + PART_SUFFIX #renamed to filepath only when completed
         if os.path.exists(filepath) and os.path.getsize(filepath) != 0:
-            if self.lock.acquire():
-                if filename.endswith('.pdf'):
-                    try:
-                        DB.loc[os.path.splitext(filename)[0], 'downloaded (PDF)?'] = True
-                    except:
-                        print(filename)
-                        print(DB.loc[os.path.splitext(filename)[0], 'downloaded (PDF)?'])
-                elif filename.endswith('.epub'):
-                    DB.loc[os.path.splitext(filename)[0], 'downloaded (ePub)?'] = True
-                self.lock.release()
+            name, ext = os.path.splitext(filename)
+            if ext in ('.pdf', '.epub'):
+                CATALOG_WRITER.mark_downloaded(name, ext.strip('.'))
             return '\n[%s] already downloaded.' % filename
         else:
             while True:
                 try:
-                    with open(filepath, 'wb') as f:
-                        try:
-                            req = urllib.request.Request(link, headers=self.headers)
-                            retval = urllib.request.urlopen(req)
-                        except: # handle "HTTP Error 400: Bad Request"
-                            alt_link = urllib.parse.quote(link, safe='/:')
-                            req = urllib.request.Request(alt_link, headers=self.headers)
-                            retval = urllib.request.urlopen(req)
-                        f.write(retval .read())
+                    RATE_LIMITER.acquire('file')
+                    offset, state = self.__load_resume__(partpath, link)
+                    try:
+                        retval = self.__open__(link, offset, state)
+                    except urllib.error.HTTPError as e:
+                        if e.code != 416:
+                            raise
+                        self.__clear_resume__(partpath) #stale partial file, restart from zero
+                        offset, state = self.__load_resume__(partpath, link)
+                        retval = self.__open__(link, offset, state)
+                    offset = self.__resumed_at__(retval, offset, state)
+                    name, ext = os.path.splitext(filename)
+                    if offset:
+                        print('%s >> [%s] resuming at %d bytes...' % (self.name, filename, offset))
+                    else: #no partial file, or the server can't resume it
+                        length = retval.headers.get('Content-Length')
+                        state = {'link' : link, 'total' : int(length) if length else None, 
+                                 'ETag' : retval.headers.get('ETag'), 
+                                 'Last-Modified' : retval.headers.get('Last-Modified')}
+                        digest = BLOB_STORE.match(ext, state['total'], link, 
+                                                  state['ETag'], state['Last-Modified'])
+                        if digest: #a book downloaded already, under another name maybe
+                            retval.close()
+                            self.__clear_resume__(partpath)
+                            BLOB_STORE.link(digest, filepath)
+                            RATE_LIMITER.success('file')
+                            if ext in ('.pdf', '.epub'):
+                                CATALOG_WRITER.mark_downloaded(name, ext.strip('.'), state['total'], digest)
+                            return '\n[%s] linked to the identical book %s.' % (filename, digest[ : 12])
+                        self.__save_resume__(partpath, state)
+                    sha256 = self.__hash_part__(partpath, offset)
+                    with open(partpath, 'ab' if offset else 'wb') as f:
+                        progress = self.__stream__(retval, f, filename, offset, sha256)
                         retval.close() #close response timely
-                    if self.lock.acquire():
-                        if filename.endswith('.pdf'):
-                            DB.loc[os.path.splitext(filename)[0], 'downloaded (PDF)?'] = True
-                        elif filename.endswith('.epub'):
-                            DB.loc[os.path.splitext(filename)[0], 'downloaded (ePub)?'] = True
-                        DOWNLOADED_COUNT += 1
-                        msg = '\n@@dowloaded-%d@@ %s :: %s >> [%s] downloaded' % (
-                            DOWNLOADED_COUNT, ctime(), self.name, filename)
-                        self.lock.release()
-                    sleep(3) #regular pause after each downloading.
-                    return msg
+                    os.replace(partpath, filepath)
+                    self.__clear_resume__(partpath)
+                    digest = sha256.hexdigest()
+                    BLOB_STORE.add(filepath, digest, ext, link, state.get('ETag'), state.get('Last-Modified'))
+                    ERROR_JOURNAL.resolve(link)
+                    RATE_LIMITER.success('file')
+                    DOWNLOAD_PROGRESS.pop(filename, None)
+                    if ext in ('.pdf', '.epub'): #queued, never waiting for the catalog
+                        CATALOG_WRITER.mark_downloaded(name, ext.strip('.'), progress['total'], digest)
+                    return '\n@@dowloaded-%d@@ %s :: %s >> [%s] downloaded (%.1f MB, %.1f KB/s)' % (
+                        DOWNLOADED_COUNT.increment(), ctime(), self.name, filename, 
+                        progress['bytes'] / 2 ** 20, progress['bytes/s'] / 2 ** 10)
                 except (ConnectionResetError, TimeoutError) as e:
                     print('\n************************%s >> %s: %s\nsleep a while and restart downloading...\n'
                           % (self.name, link, e))
@@ -461,72 +2386,626 @@ class Downloader(Thread):
                         retval.close() #close response timely, if necessary
                     except:
                         pass
-                    sleep(3) #pause a little while, if Exception happens.
+                    sleep(RATE_LIMITER.failure('file', e)) #back off a while, if Exception happens.
                 except Exception as e:
                     msg = '************************%s >> [%s] download failed: %s\n' % (
                             self.name, link, e)
-                    if ('timed out' in msg) or ('IncompleteRead' in msg):
+                    if ('timed out' in msg) or ('IncompleteRead' in msg) or IS_THROTTLED(e):
                         print('%ssleep a while and restart downloading...\n' % msg)
                         try:
                             retval.close() #close response timely, if necessary
                         except:
                             pass
-                        sleep(3) #pause a little while, if Exception happens.
+                        sleep(RATE_LIMITER.failure('file', e)) #back off a while, if Exception happens.
                     else:
+                        DOWNLOAD_PROGRESS.pop(filename, None)
                         try:
-                            os.remove(filepath) #remove void file before close(), avoiding error closing.
+                            self.__clear_resume__(partpath) #remove void file before close(), avoiding error closing.
                             retval.close() #close response timely, if necessary
                         except:
                             pass
-                        ERROR_COUNT += 1
-                        msg = '\n(ERROR-%d) %s%s' % (ERROR_COUNT, ctime(), msg)
-                        if not self.err_links:
-                            with open(BUG_FILE, 'at') as f:
-                                f.write(msg)
+                        msg = '\n(ERROR-%d) %s%s' % (ERROR_COUNT.increment(), ctime(), msg)
+                        ERROR_JOURNAL.record(link, 'file', e, file = filename) #attempts counted per url
                         return msg
     
     def run(self):
         '''download books
 '''
-        global BUG_DB
+        global BUG_ROWS
         while True:
-            file_link = self.pdf_links.get()
-            if file_link == 'finished':
+            anchor = self.pdf_links.get()
+            if anchor == 'finished':
                 break
             else:
-                msg = self.__download_file__(file_link)
+                msg = self.__download_file__(anchor)
                 print(msg)
                 if self.err_links:
                     if 'download failed' in msg:
-                        name = os.path.splitext(file_link.split('&&&')[0])[0]
-                        if self.lock.acquire():
-                            BUG_DB.loc[name, 'Error Msg.'] = msg.split('download failed:')[1].strip()
-                            self.lock.release()
+                        with self.lock: #BUG_ROWS
+                            BUG_ROWS.setdefault(anchor.name, {})['Error Msg.'] = \
+                                msg.split('download failed:')[1].strip()
+
+DOWNLOAD_POLICIES = { # download priorities, the lower first
+    'discovery' : lambda anchor : 0, # in the order found, i.e. by the sequence number alone
+    'small-first' : lambda anchor : float(2 ** 53) if anchor.size is None else anchor.size, # unknown sizes last
+    'pdf-first' : lambda anchor : 0 if anchor.ext == 'pdf' else 1,
+    'newest-first' : lambda anchor : -int(anchor.year) if anchor.year else 0,
+}
+DOWNLOAD_POLICY = ('small-first', ) # policies compared in turn, e.g. ('pdf-first', 'newest-first')
+BACKLOG_MEMORY = 1000 # downloads waiting in memory, the rest are spilled to disk
+
+class DownloadScheduler(object):
+    '''the links queue of LinkProducer and Downloader threads: put never blocks, so book pages 
+are parsed on however slow the downloads are, and get hands out the download first in 
+policy order (see DOWNLOAD_POLICIES) instead of in the order found. Up to memory downloads
+wait in a heap, the rest are spilled to a temporary SQLite file and read back in order.
+'finished' is handed out once nothing else is left.
+'''
+    def __init__(self, policy = DOWNLOAD_POLICY, memory = BACKLOG_MEMORY):
+        policy = (policy, ) if isinstance(policy, str) else tuple(policy)
+        for name in policy:
+            if name not in DOWNLOAD_POLICIES:
+                raise ValueError('Unknown download policy: %s' % name)
+        self.policy = policy
+        self.memory = max(memory, 2)
+        self.heap = [] # (key, anchor), all keys below those spilled
+        self.sequence = itertools.count() # the order found, the last part of each key
+        self.spilled = 0
+        self.spilled_min = None # the least key spilled
+        self.finished = 0
+        self.backlog = None # the temporary SQLite database, opened on the first spill
+        self.cond = Condition()
+
+    def __key__(self, anchor):
+        return tuple(DOWNLOAD_POLICIES[name](anchor) for name in self.policy) + (next(self.sequence), )
+
+    def __spill__(self, items):
+        # items, [(key, anchor), ...] in key order
+        if self.backlog is None:
+            self.backlog = sqlite3.connect('', check_same_thread = False) # a temporary file, removed on close
+            self.columns = ', '.join('k%d' % i for i in range(len(self.policy) + 1))
+            self.backlog.execute('CREATE TABLE backlog (%s, anchor TEXT)' % self.columns)
+            self.backlog.execute('CREATE INDEX backlog_key ON backlog (%s)' % self.columns)
+        self.backlog.executemany('INSERT INTO backlog VALUES (%s?)' % ('?, ' * (len(self.policy) + 1)), 
+                                 [key + (json.dumps(anchor), ) for key, anchor in items])
+        self.spilled += len(items)
+        if self.spilled_min is None or items[0][0] < self.spilled_min:
+            self.spilled_min = items[0][0]
+
+    def __refill__(self):
+        # read the first half of memory back from disk
+        rows = self.backlog.execute('SELECT rowid, %s, anchor FROM backlog ORDER BY %s LIMIT ?' 
+                                    % (self.columns, self.columns), (self.memory // 2, )).fetchall()
+        self.backlog.executemany('DELETE FROM backlog WHERE rowid = ?', [row[ : 1] for row in rows])
+        self.heap = [(tuple(row[1 : -1]), Anchor(*json.loads(row[-1]))) for row in rows] # sorted, a heap
+        self.spilled -= len(rows)
+        first = self.backlog.execute('SELECT %s FROM backlog ORDER BY %s LIMIT 1' 
+                                     % (self.columns, self.columns)).fetchone()
+        self.spilled_min = tuple(first) if first else None
+
+    def put(self, anchor):
+        with self.cond:
+            if anchor == 'finished':
+                self.finished += 1
+            else:
+                key = self.__key__(anchor)
+                if self.spilled_min is not None and key > self.spilled_min: #after the spilled ones
+                    self.__spill__([(key, anchor)])
+                else:
+                    heapq.heappush(self.heap, (key, anchor))
+                    if len(self.heap) > self.memory: #keep the first half in memory
+                        self.heap.sort()
+                        self.heap, spilled = self.heap[ : self.memory // 2], self.heap[self.memory // 2 : ]
+                        self.__spill__(spilled)
+            self.cond.notify()
+
+    def get(self):
+        with self.cond:
+            while True:
+                if not self.heap and self.spilled:
+                    self.__refill__()
+                if self.heap:
+                    return heapq.heappop(self.heap)[1]
+                if self.finished:
+                    self.finished -= 1
+                    return 'finished'
+                self.cond.wait()
+
+    def qsize(self):
+        with self.cond:
+            return len(self.heap) + self.spilled
+
+    def close(self):
+        if self.backlog is not None:
+            self.backlog.close()
+            self.backlog = None
+
+class AsyncLinkQueue(object):
+    '''stands for the links queue of LinkProducer in AsyncEngine, "put" spawns a download
+task on the event loop from any thread
+'''
+    def __init__(self, loop, spawn):
+        self.loop = loop
+        self.spawn = spawn
+
+    def put(self, anchor):
+        self.loop.call_soon_threadsafe(self.spawn, anchor)
+
+class AsyncEngine(object):
+    '''an asyncio alternative to one LinkProducer thread and a fixed number of Downloader 
+threads: listing pages, book pages and file downloads are tasks with separate concurrency
+limits. The blocking fetches, parsers and catalog updates of LinkProducer / Downloader are
+reused as they are, and run in a thread pool.
+'''
+    def __init__(self, headers, book_dirname, lock, concurrency = None, 
+                 updating = False, start_page = None, chunk_size = CHUNK_SIZE, base_url = BASE_URL):
+        self.concurrency = dict(CONCURRENCY, **(concurrency or {}))
+        self.producer = LinkProducer(headers, None, 0, lock, 'AsyncProducer', updating, start_page, 
+                                     base_url = base_url)
+        self.downloader = Downloader(headers, None, book_dirname, lock, name = 'AsyncDownloader', 
+                                     chunk_size = chunk_size)
+        self.lock = lock
+        self.downloads = []
+
+    def run(self):
+        asyncio.run(self.__main__())
+
+    async def __run_blocking__(self, func, *args):
+        return await self.loop.run_in_executor(self.executor, func, *args)
+
+    def __spawn_download__(self, anchor):
+        self.downloads.append(self.loop.create_task(self.__download__(anchor)))
+
+    async def __download__(self, anchor):
+        async with self.limits['download']:
+            print(await self.__run_blocking__(self.downloader.__download_file__, anchor))
+
+    async def __listing__(self, page):
+        async with self.limits['listing']:
+            return await self.__run_blocking__(self.producer.__fetch_listing__, page)
+
+    async def __bookpage__(self, link):
+        async with self.limits['bookpage']:
+            await self.__run_blocking__(self.producer.__parse_link__, link)
+
+    def __flush__(self):
+        CATALOG_WRITER.flush()
+
+    async def __main__(self):
+        global CATALOG
+        self.loop = asyncio.get_running_loop()
+        self.executor = ThreadPoolExecutor(max_workers = sum(self.concurrency.values()))
+        self.limits = {kind : asyncio.Semaphore(n) for kind, n in self.concurrency.items()}
+        self.producer.pdf_links = AsyncLinkQueue(self.loop, self.__spawn_download__)
+        METRICS.gauge('queue depth', lambda : sum(not task.done() for task in list(self.downloads)))
+        page = await self.__run_blocking__(self.producer.__first_page__)
+        planned = [self.loop.create_task(self.__bookpage__(link)) for link in self.producer.planned]
+        listings = {} # listing pages fetched ahead, page -> task
+        all_downloaded = False
+        while not all_downloaded:
+            for ahead in range(page, page + self.concurrency['listing']):
+                if ahead not in listings:
+                    listings[ahead] = self.loop.create_task(self.__listing__(ahead))
+            print('\n\n%sProcessing Page-%d%s\n' % ('+' * 30, page, '+' * 30))
+            try:
+                anchorlist = await listings.pop(page)
+                new_links = []
+                for link in anchorlist:
+                    if self.producer.__is_new__(link):
+                        new_links.append(link)
+                    elif self.producer.updating and (not self.producer.start_page): #regular updating
+                        all_downloaded = True
+                        break
+                await asyncio.gather(*[self.__bookpage__(link) for link in new_links])
+                page = await self.__run_blocking__(self.producer.__page_done__, page, bool(new_links))
+            except Exception as e:
+                print('\n************************Page-%d: %s' % (page, e))
+                print('All pages (1~%d) have been parsed.' % (page - 1))
+                all_downloaded = True
+        for task in listings.values(): # pages fetched ahead beyond the last one
+            task.cancel()
+        await asyncio.gather(*listings.values(), return_exceptions = True)
+        for result in await asyncio.gather(*planned, return_exceptions = True):
+            if isinstance(result, Exception):
+                print('\n************************%s' % result)
+        await self.__run_blocking__(self.__flush__)
+        while self.downloads: # downloads may still be spawned by the last book pages
+            downloads, self.downloads = self.downloads, []
+            await asyncio.gather(*downloads)
+        self.executor.shutdown()
+
+WORK_QUEUE_PATH = 'allitebooks-work.sqlite' # work items shared by the processes of the shard engine
+LEASE_TIME = 60 # seconds an item is held by a worker unless renewed, then issued again
+LEASE_ATTEMPTS = 5 # an item failing, or expiring, this many times is given up
+LEASE_POLL = 0.25 # seconds to wait while all items left are leased by other workers
+LEASE_KINDS = ('file', 'bookpage', 'listing') # leased in this order, downloads drained first
+
+class WorkQueue(object):
+    '''a durable queue of listing pages, book pages and files in an SQLite file, shared by 
+worker processes: each item is put once by its key, and leased by one worker at a time. 
+Leases expire unless renewed, so the items of a crashed worker are issued again. 
+Processes on several hosts need the file on a shared file system with working locks.
+'''
+    def __init__(self, path = WORK_QUEUE_PATH, lease_time = LEASE_TIME, attempts = LEASE_ATTEMPTS):
+        self.path = path
+        self.lease_time = lease_time
+        self.attempts = attempts
+        self.lock = Lock() # one connection, shared by the threads of a worker
+        self.conn = sqlite3.connect(path, timeout = 60, check_same_thread = False, isolation_level = None)
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS items (
+                             id INTEGER PRIMARY KEY, kind TEXT, key TEXT, payload TEXT, 
+                             state TEXT DEFAULT 'ready', owner TEXT, expires REAL, 
+                             attempts INTEGER DEFAULT 0, error TEXT, UNIQUE (kind, key))''')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS items_state ON items (state)')
+        self.order = 'CASE kind %s END' % ' '.join("WHEN '%s' THEN %d" % (kind, i) 
+                                                   for i, kind in enumerate(LEASE_KINDS))
+
+    @contextmanager
+    def __transaction__(self):
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE') # the write lock first, no lease taken twice
+            try:
+                yield self.conn
+            except:
+                self.conn.execute('ROLLBACK')
+                raise
+            self.conn.execute('COMMIT')
+
+    def put(self, kind, items):
+        # items, {key : payload}, new ones only, the rest are left as they are
+        if items:
+            with self.__transaction__() as conn:
+                conn.executemany('INSERT OR IGNORE INTO items (kind, key, payload) VALUES (?, ?, ?)', 
+                                 [(kind, str(key), json.dumps(payload)) for key, payload in items.items()])
+
+    def lease(self, owner):
+        '''(id, kind, key, payload) of an item for owner to work on, or None if none is free
+'''
+        now = time()
+        with self.__transaction__() as conn:
+            conn.execute("UPDATE items SET state = 'failed', error = 'lease expired' "
+                         "WHERE state = 'leased' AND expires < ? AND attempts >= ?", (now, self.attempts))
+            item = conn.execute("SELECT id, kind, key, payload FROM items WHERE state = 'ready' "
+                                "OR (state = 'leased' AND expires < ?) ORDER BY %s, id LIMIT 1" 
+                                % self.order, (now, )).fetchone()
+            if item is None:
+                return None
+            conn.execute("UPDATE items SET state = 'leased', owner = ?, expires = ?, attempts = attempts + 1 "
+                         "WHERE id = ?", (owner, now + self.lease_time, item[0]))
+        return item[ : 3] + (json.loads(item[3]), )
+
+    def renew(self, owner):
+        # extend all leases of owner, i.e. a heartbeat
+        with self.__transaction__() as conn:
+            conn.execute("UPDATE items SET expires = ? WHERE owner = ? AND state = 'leased'", 
+                         (time() + self.lease_time, owner))
+
+    def done(self, item_id, owner):
+        with self.__transaction__() as conn:
+            conn.execute("UPDATE items SET state = 'done', error = NULL WHERE id = ? AND owner = ?", 
+                         (item_id, owner))
+
+    def fail(self, item_id, owner, error):
+        # issue the item again, or give it up after the last attempt
+        with self.__transaction__() as conn:
+            conn.execute("UPDATE items SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'ready' END, "
+                         "owner = NULL, error = ? WHERE id = ? AND owner = ?", 
+                         (self.attempts, str(error), item_id, owner))
+
+    def counts(self):
+        # {state : items}
+        with self.lock:
+            return dict(self.conn.execute('SELECT state, count(*) FROM items GROUP BY state'))
+
+    def close(self):
+        self.conn.close()
+
+class ShardEngine(object):
+    '''one of the worker processes crawling together through a WorkQueue, on one host or 
+several: threads of the process lease listing pages, which put their pages to come and 
+book pages, book pages which put their files, and files. The fetches, parsers and catalog 
+updates of LinkProducer / Downloader are reused as they are, results of all processes are 
+merged into the shared SQLite catalog by book name.
+'''
+    def __init__(self, headers, book_dirname, lock, parallels, start_page = None, 
+                 chunk_size = CHUNK_SIZE, base_url = BASE_URL, path = WORK_QUEUE_PATH):
+        global CATALOG
+        if CATALOG.backend != 'sqlite':
+            raise ValueError('The shard engine needs the sqlite catalog backend')
+        CATALOG.shared = True
+        self.headers = headers
+        self.book_dirname = book_dirname
+        self.lock = lock
+        self.parallels = parallels
+        self.start_page = start_page or 1
+        self.chunk_size = chunk_size
+        self.base_url = base_url
+        self.queue = WorkQueue(path)
+        self.owner = '%s-%d' % (socket.gethostname(), os.getpid())
+        self.stopped = Event()
+        if ARCHIVE.path: # one archive per process, e.g. 'host-1234.crawl.warc.gz', see CrawlArchive.replay
+            dirname, filename = os.path.split(ARCHIVE.path)
+            ARCHIVE.path = os.path.join(dirname, '%s.%s' % (self.owner, filename))
+
+    def __listing__(self, producer, downloader, page):
+        global CATALOG
+        try:
+            anchorlist = producer.__fetch_listing__(int(page))
+        except urllib.error.HTTPError as e:
+            if e.code == 404: #past the last page
+                return
+            raise
+        last = max(producer.last_page, int(page) + 1) #the next page at least, without pagination links
+        self.queue.put('listing', {p : None for p in range(int(page) + 1, last + 1)})
+        self.queue.put('bookpage', {link : None for link in anchorlist if producer.__is_new__(link)})
+
+    def __bookpage__(self, producer, downloader, link):
+        producer.__parse_link__(link)
+        CATALOG_WRITER.flush() #the row is shared before its files are downloaded elsewhere
+        anchors = []
+        while not producer.pdf_links.empty():
+            anchors.append(producer.pdf_links.get_nowait())
+        self.queue.put('file', {anchor.url : list(anchor) for anchor in anchors})
+
+    def __file__(self, producer, downloader, anchor):
+        msg = downloader.__download_file__(Anchor(*anchor))
+        print(msg)
+        if 'download failed' in msg:
+            raise IOError(msg.split('download failed:')[1].strip())
+
+    def __work__(self, i):
+        # lease, work and report items until none is left in any process
+        producer = LinkProducer(self.headers, Queue(), 0, self.lock, 'ShardProducer-%d' % i, 
+                                base_url = self.base_url)
+        downloader = Downloader(self.headers, None, self.book_dirname, self.lock, 
+                                name = 'ShardDownloader-%d' % i, chunk_size = self.chunk_size)
+        while True:
+            item = self.queue.lease(self.owner)
+            if item is None:
+                counts = self.queue.counts()
+                if not counts.get('ready') and not counts.get('leased'):
+                    break
+                sleep(LEASE_POLL)
+                continue
+            item_id, kind, key, payload = item
+            try:
+                with METRICS.timed('lease ' + kind):
+                    getattr(self, '__%s__' % kind)(producer, downloader, payload if kind == 'file' else key)
+                CATALOG_WRITER.flush() #done once its results are persisted, not lost with the process
+                self.queue.done(item_id, self.owner)
+            except Exception as e:
+                print('\n************************%s %s: %s' % (kind, key, e))
+                METRICS.count('lease failures', kind = kind)
+                self.queue.fail(item_id, self.owner, e)
+
+    def __heartbeat__(self):
+        while not self.stopped.wait(self.queue.lease_time / 3):
+            self.queue.renew(self.owner)
+
+    def run(self):
+        self.queue.put('listing', {self.start_page : None})
+        METRICS.gauge('queue depth', lambda : self.queue.counts().get('ready', 0))
+        heartbeat = Thread(target = self.__heartbeat__, name = 'ShardHeartbeat', daemon = True)
+        heartbeat.start()
+        workers = [Thread(target = self.__work__, args = (i + 1, ), name = 'ShardWorker-%d' % (i + 1)) 
+                   for i in range(self.parallels)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.stopped.set()
+        CATALOG_WRITER.flush()
+        counts = self.queue.counts()
+        print('No work left in %s: %s' % (self.queue.path, ', '.join('%d %s' % (n, state) 
+                                                                    for state, n in sorted(counts.items()))))
+
+VERIFY_WORKERS = None # processes verifying downloaded files, None for the CPU count
+WRONG_BOOKS_DIRNAME = 'wrong_books' # corrupt files are moved here, then downloaded again
+PDF_XREF = re.compile(rb'\s*(xref|\d+\s+\d+\s+obj)') # what startxref should point at
+EPUB_MIMETYPE = b'application/epub+zip'
+
+def VERIFY_PDF(path, size):
+    # header, %%EOF trailer, and a startxref pointing at a cross-reference table / stream
+    with open(path, 'rb') as f:
+        head = f.read(1024)
+        f.seek(max(size - 2048, 0))
+        tail = f.read()
+        header = head.find(b'%PDF-')
+        if header < 0:
+            return 'No %PDF- header'
+        if b'%%EOF' not in tail:
+            return 'No %%EOF trailer'
+        offsets = re.findall(rb'startxref\s+(\d+)', tail)
+        if not offsets:
+            return 'No startxref'
+        for offset in {int(offsets[-1]), int(offsets[-1]) + header}: # offsets may count from %PDF-
+            if offset < size:
+                f.seek(offset)
+                if PDF_XREF.match(f.read(64)):
+                    return None
+    return 'startxref %s points at no cross-reference' % offsets[-1].decode()
+
+def VERIFY_EPUB(path):
+    # a sound zip with the epub mimetype and META-INF/container.xml
+    try:
+        with zipfile.ZipFile(path) as book:
+            names = book.namelist()
+            if 'mimetype' not in names or book.read('mimetype').strip() != EPUB_MIMETYPE:
+                return 'No epub mimetype'
+            if 'META-INF/container.xml' not in names:
+                return 'No META-INF/container.xml'
+            bad = book.testzip()
+            if bad:
+                return 'Bad zip member %s' % bad
+    except (zipfile.BadZipFile, zlib.error, EOFError) as e:
+        return 'Bad zip file: %s' % e
+    return None
+
+def VERIFY_BOOK(path, expected_size = None):
+    '''(path, error) of a downloaded .pdf / .epub, error is None for a sound file.
+expected_size, the Content-Length it was downloaded with, if known
+Run in worker processes, so module-level and free of shared state.
+'''
+    try:
+        size = os.path.getsize(path)
+        if expected_size and size != expected_size:
+            return path, 'Size %d, Content-Length %d' % (size, expected_size)
+        if path.lower().endswith('.pdf'):
+            return path, VERIFY_PDF(path, size)
+        return path, VERIFY_EPUB(path)
+    except OSError as e:
+        return path, str(e)
 
 class AllITeBooksCrawler(object):
     '''manage entire crawling process
 '''
-    def __init__(self, book_dirname = 'books', updating = False, start_page = None):
+    def __init__(self, book_dirname = 'books', updating = False, start_page = None, 
+                 engine = 'threads', concurrency = None, chunk_size = CHUNK_SIZE, 
+                 pool_size = POOL_SIZE, rate_budgets = None, cache_dir = CACHE_DIR, offline = False, 
+                 status_port = None, base_url = BASE_URL, work_queue = WORK_QUEUE_PATH, 
+                 download_policy = DOWNLOAD_POLICY, bandwidth = BANDWIDTH, archive = ARCHIVE_PATH, 
+                 replay = None):
         self.h = {'User-Agent':'Mozilla/5.0'} 
         self.parallels = 8 # parallel downloading allowed
-        self.q = Queue(maxsize = self.parallels) #.pdf / .epub links
+        self.q = DownloadScheduler(download_policy) #.pdf / .epub links, by priority
         self.err_q = Queue() # error links to reparse
         self.book_dirname = book_dirname
         if not os.path.exists(self.book_dirname):
             os.makedirs(self.book_dirname)
-        self.lock = Lock()
+        self.lock = TimedLock() # BUG_ROWS of downloaders, waits reported to METRICS
         self.updating = updating
         self.start_page = start_page #crawl from this page, in case any interrupt
+        if engine not in ENGINES:
+            raise ValueError('Unknown engine: %s' % engine)
+        self.engine = engine # 'threads', 'asyncio' or 'shard'
+        self.concurrency = concurrency # concurrent requests of each kind, see CONCURRENCY
+        self.chunk_size = chunk_size # download chunk size in bytes
+        HTTP_POOL.pool_size = pool_size # keep-alive connections per host
+        if rate_budgets: # e.g. {'file' : {'max' : 2.0}}, see RATE_BUDGETS
+            RATE_LIMITER.configure(rate_budgets)
+        PAGE_CACHE.relocate(cache_dir) # None to disable the page cache
+        BLOB_STORE.relocate(os.path.join(book_dirname, BLOB_DIRNAME))
+        self.status_port = status_port # serve METRICS on this local port while crawling, 0 for any
+        self.base_url = base_url # the site, or a stand-in of it, e.g. benchmark.py
+        self.work_queue = work_queue # WorkQueue file of the shard engine
+        PAGE_CACHE.offline = offline or bool(replay) # parse cached pages only, download nothing
+        BANDWIDTH_LIMITER.rate = bandwidth # bytes per second of all downloads, None for no limit
+        ARCHIVE.close() # the archive of an earlier crawler, if any, opened again on the next record
+        ARCHIVE.path = archive # every page fetched is archived here, None for no archive
+        if replay: # read pages from these archives only, see CrawlArchive.replay
+            ARCHIVE.replay(replay)
+        elif ARCHIVE.replaying: # of an earlier crawler in this process
+            ARCHIVE.close()
+            ARCHIVE.replaying, ARCHIVE.index = False, {}
 
     def go(self): # process links in queue
+        METRICS.reset()
+        METRICS.gauge('downloaded', lambda : DOWNLOADED_COUNT.value)
+        METRICS.gauge('errors', lambda : ERROR_COUNT.value)
+        METRICS.gauge('links', lambda : LinkProducer.link_count.value)
+        METRICS.gauge('catalog queue depth', CATALOG_WRITER.updates.qsize)
+        status_server = START_STATUS_SERVER(self.status_port) if self.status_port is not None else None
+        if self.engine == 'asyncio':
+            AsyncEngine(self.h, self.book_dirname, self.lock, self.concurrency, 
+                        self.updating, self.start_page, self.chunk_size, self.base_url).run()
+        elif self.engine == 'shard':
+            ShardEngine(self.h, self.book_dirname, self.lock, self.parallels, self.start_page, 
+                        self.chunk_size, self.base_url, self.work_queue).run()
+        else:
+            self.__go_threads__()
+        metrics_file = METRICS_FILE
+        if self.engine == 'shard': #other workers may be running, see SHARD_WORKERS
+            CATALOG_WRITER.flush()
+            metrics_file = '%s-%d.json' % (os.path.splitext(METRICS_FILE)[0], os.getpid())
+        else:
+            if ARCHIVE.replaying:
+                print('All archived pages replayed!')
+            elif PAGE_CACHE.offline:
+                print('All cached pages parsed!')
+            else:
+                print('All books downloaded!')
+                self.reparse_Errors() #verify downloaded files, then reparse the error journal
+            self.statistic_DB()
+            CATALOG_WRITER.flush()
+            with CATALOG.lock:
+                CATALOG.snapshot() #fast loading next time
+        ARCHIVE.close()
+        print(METRICS.summary())
+        with open(metrics_file, 'wt') as f:
+            json.dump(METRICS.snapshot(), f, indent = 1)
+        if status_server:
+            status_server.shutdown()
+
+    def __cached_bookpages__(self, batch_size):
+        # (url, html bytes) of cached book pages, batch_size pages at a time
+        batch = []
+        for url in PAGE_CACHE.urls():
+            if PAGE_LINK.search(url.rstrip('/')): #listing pages
+                continue
+            cached = PAGE_CACHE.get(url)
+            if cached:
+                batch.append((url, cached[0]))
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def __archived_bookpages__(self, archive, batch_size):
+        # (url, html bytes) of the latest records of book pages in archive, batch_size pages at a time
+        batch = []
+        for url in archive.urls():
+            if PAGE_LINK.search(url.rstrip('/')): #listing pages
+                continue
+            archived = archive.get(url)
+            if archived and archived[0] == 200:
+                batch.append((url, archived[2]))
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def __reparse__(self, batches, processes):
+        # record the books of batches of book pages, parsing in a process pool unless processes is 0
+        producer = LinkProducer(self.h, None, 0, self.lock, 'CacheParser', base_url = self.base_url)
+        pool = ProcessPoolExecutor(max_workers = processes) if processes != 0 else None
+        count = 0
+        for batch in batches: #pages read in batches, bounding memory
+            books = pool.map(PARSE_BOOKPAGE, batch, chunksize = 16) if pool else map(PARSE_BOOKPAGE, batch)
+            for (url, content), book in zip(batch, books):
+                producer.__record__(url, book)
+                count += 1
+        if pool:
+            pool.shutdown()
+        CATALOG_WRITER.flush()
+        return count
+
+    def reparse_Cache(self, processes = PARSE_WORKERS, batch_size = 256):
+        # re-extract the catalog from all cached book pages, e.g. after a parser fix,
+        # without touching the network, parsing in a process pool unless processes is 0
+        count = self.__reparse__(self.__cached_bookpages__(batch_size), processes)
+        print('%d cached book pages reparsed.' % count)
+
+    def reparse_Archive(self, paths = ARCHIVE_PATH, processes = PARSE_WORKERS, batch_size = 256):
+        # the same from the book pages of archives, see CrawlArchive.replay, read at disk speed
+        archive = CrawlArchive(None)
+        archive.replay(paths)
+        count = self.__reparse__(self.__archived_bookpages__(archive, batch_size), processes)
+        archive.close()
+        print('%d archived book pages reparsed.' % count)
+
+    def __go_threads__(self): # one producer and parallel downloaders
         producer_name = 'LinkUpdater' if self.updating else 'LinkProducer'
         producer = LinkProducer(self.h, self.q, self.parallels, self.lock, 
-                                producer_name, self.updating, self.start_page)
+                                producer_name, self.updating, self.start_page, self.concurrency, 
+                                self.base_url)
         consumers = []
         for i in range(self.parallels):
             consumers.append(Downloader(self.h, self.q, self.book_dirname, self.lock, 
-                                        name = 'Downloader-%d' % (i + 1)))
+                                        name = 'Downloader-%d' % (i + 1), chunk_size = self.chunk_size))
 
+        METRICS.gauge('queue depth', self.q.qsize)
         producer.start()
         for i in range(self.parallels):
             consumers[i].start()
@@ -534,143 +3013,214 @@ class AllITeBooksCrawler(object):
         producer.join()
         for i in range(self.parallels):
             consumers[i].join()
-        print('All books downloaded!')
-        self.reparse_Errors() #only reparse 'bug.txt' and 'wrong_books' if necessary
-        self.statistic_DB()
+        self.q.close() #the spilled backlog, if any
+
+    def verify_Books(self, recheck = False):
+        '''verify downloaded files in a process pool (see VERIFY_BOOK), recording 'verified (PDF)?'
+/ 'verified (ePub)?' in the catalog. Corrupt files are moved to WRONG_BOOKS_DIRNAME and put 
+into the error journal, to be downloaded again. Returns {file : (link, error)} of them.
+recheck, verify the files verified already as well
+'''
+        global CATALOG, CATALOG_WRITER, ERROR_JOURNAL
+        CATALOG_WRITER.flush()
+        db = CATALOG.db
+        columns = {column : db[column].to_dict() if column in db.columns else {} 
+                   for fmt in ('PDF', 'ePub') 
+                   for column in ('verified (%s)?' % fmt, 'bytes (%s)' % fmt, 'sha256 (%s)' % fmt, 
+                                  'link-%s' % fmt.lower())} #read before CATALOG_WRITER changes db
+        jobs = {} # path -> (name, ext, Content-Length)
+        for file in os.listdir(self.book_dirname):
+            name, ext = os.path.splitext(file)
+            fmt = {'.pdf' : 'PDF', '.epub' : 'ePub'}.get(ext) # '.part' files are skipped
+            if fmt is None:
+                continue
+            if (not recheck) and columns['verified (%s)?' % fmt].get(name) == True: # nan if unverified
+                continue
+            size = columns['bytes (%s)' % fmt].get(name)
+            jobs[os.path.join(self.book_dirname, file)] = (
+                name, ext.strip('.'), int(size) if pandas.notnull(size) else None)
+        if not jobs:
+            return {}
+        print('%s\nverifying %d downloaded files...' % ('=' * 60, len(jobs)))
+        paths = list(jobs)
+        with ProcessPoolExecutor(max_workers = VERIFY_WORKERS) as pool:
+            results = list(pool.map(VERIFY_BOOK, paths, [jobs[path][2] for path in paths], 
+                                    chunksize = 16))
+        corrupt = {}
+        for path, error in results:
+            name, ext = jobs[path][ : 2]
+            fmt = {'pdf' : 'PDF', 'epub' : 'ePub'}[ext]
+            if error is None:
+                CATALOG_WRITER.update(name, {'verified (%s)?' % fmt : True})
+                continue
+            file = os.path.basename(path)
+            print('Incorrect file: %s, %s' % (file, error))
+            if not os.path.exists(WRONG_BOOKS_DIRNAME):
+                os.makedirs(WRONG_BOOKS_DIRNAME)
+            os.replace(path, os.path.join(WRONG_BOOKS_DIRNAME, file))
+            digest = columns['sha256 (%s)' % fmt].get(name)
+            if pandas.notnull(digest): #never linked again
+                BLOB_STORE.discard(digest)
+            CATALOG_WRITER.update(name, {'verified (%s)?' % fmt : False, 'downloaded (%s)?' % fmt : False})
+            link = columns['link-%s' % ext].get(name)
+            if pandas.notnull(link):
+                ERROR_JOURNAL.record(link, 'file', error, 'CorruptFile', file)
+            corrupt[file] = (link, error)
+        CATALOG_WRITER.flush()
+        print('%d files verified, %d corrupt.' % (len(results), len(corrupt)))
+        return corrupt
 
     def reparse_Errors(self):
-        # reparse all error links in BUG_FILE and fault files downloaded, 
+        # reparse all error links in ERROR_JOURNAL and fault files downloaded, 
         # to remedy or confirm, and build error database
-        global BUG_FILE, DB, DB_PATH, BUG_DB, BUG_DBFILE, FORMAT_TO_FILENAME            
-        url_db = DB[['link-pdf', 'link-epub']].reset_index()
+        global ERROR_JOURNAL, CATALOG, BUG_ROWS, BUG_DBFILE, FORMAT_TO_FILENAME
 
-        print('%s\nreparsing BUG_FILE...' % ('=' * 60))
-        with open(BUG_FILE) as f:
-            for line in f:
-                if line.strip():
-                    url = line.split('[')[1].split(']')[0]
-                    unquoted_link = urllib.parse.unquote(url)
-                    bug_item = pandas.Series()
-                    if 'No pdf/epub anchor' in line:
-                        name = FORMAT_TO_FILENAME(os.path.split(unquoted_link.strip('/'))[1])
-                        bug_item = pandas.Series(name = name)
-                        bug_item['Link']  = url
-                        bug_item['Error Msg.'] = 'No pdf/epub anchor'
-                    else:
-                        for ext in ('pdf', 'epub'):
-                            if ext in url:
-                                try:
-                                    name = url_db.set_index('link-%s' % ext).loc[url, 'name']
-                                except:
-                                    name = os.path.splitext(os.path.split(unquoted_link)[1])[0]
-                                    print(name)
-                                file = '.'.join([name, ext])
-                                if os.path.exists(os.path.join(self.book_dirname, file)):
-                                    print('[%s] already downloaded.' % file)
-                                    break
-                                else:
-                                    bug_item = pandas.Series(name = name)
-                                    bug_item['Link']  = url
-                                    bug_item['Error Msg.'] = line.split('download failed:')[1].strip()
-                                    #if ('HTTP Error 400' in line) or ('IncompleteRead' in line): #reparse some errors
-                                    file_link = '&&&'.join([file, url]) #reparse all errors with .pdf / .epub links
-                                    self.err_q.put(file_link)
-                                    break
-                    if bug_item.any():
-                        if bug_item.name in BUG_DB.index:
-                            BUG_DB.loc[bug_item.name] = bug_item
-                        else:
-                            BUG_DB = BUG_DB.append(bug_item)
-            for i in range(self.parallels):
-                self.err_q.put('finished')
-
-            consumers = []
-            for i in range(self.parallels):
-                consumers.append(Downloader(self.h, self.err_q, self.book_dirname, self.lock,
-                                        name = 'Downloader-%d(err_links)' % (i + 1), err_links = True))
-            for i in range(self.parallels):
-                consumers[i].start()
-            for i in range(self.parallels):
-                consumers[i].join()
-            print('BUG_FILE reparsed.')
-
-        print('Please check your directory (default "books\"), if there is any incorrect files that \
-can NOT be opened, move it to another directory (default "wrong_books\")')
-        while True:
-            try:
-                if input('If you finished, please confirm by [y]: ').strip()[0].lower() == 'y':
-                    break
-            except:
-                pass
-        if os.path.exists('wrong_books'):
-            print('%s\nreparseing wrong books...' % ('=' * 60))
-            for file in os.listdir('wrong_books'):
-                print('Incorrect file: %s' % file)
-                bug_item = pandas.Series(name = os.path.splitext(file)[0])
-                ext = os.path.splitext(file)[1].strip('.')
-                bug_item['Link'] = DB.loc[bug_item.name, 'link-%s' % ext]
-                bug_item['Error Msg.'] = 'Bad file, cannot be opened'
-                if bug_item.name in BUG_DB.index:
-                    BUG_DB.loc[bug_item.name] = bug_item
+        self.verify_Books() #corrupt files are put into the error journal, downloaded again below
+        print('%s\nreparsing error journal...' % ('=' * 60))
+        for record in ERROR_JOURNAL.values():
+            url = record['url']
+            unquoted_link = urllib.parse.unquote(url)
+            if record['kind'] == 'bookpage':
+                name = FORMAT_TO_FILENAME(os.path.split(unquoted_link.strip('/'))[1])
+                BUG_ROWS[name] = {'Link' : url, 'Error Msg.' : record['error']}
+            else:
+                ext = 'epub' if url.lower().endswith('epub') else 'pdf'
+                name = CATALOG.index.name_of(url, ext)
+                if name is None:
+                    name = os.path.splitext(record.get('file') or os.path.split(unquoted_link)[1])[0]
+                    print(name)
+                file = '.'.join([name, ext])
+                if os.path.exists(os.path.join(self.book_dirname, file)):
+                    print('[%s] already downloaded.' % file)
+                    ERROR_JOURNAL.resolve(url)
                 else:
-                    BUG_DB = BUG_DB.append(bug_item)
-            print('Wrong books reparsed.')
+                    BUG_ROWS[name] = {'Link' : url, 'Error Msg.' : record['error']}
+                    self.err_q.put(Anchor(name, url, ext)) #reparse all errors with .pdf / .epub links
+        for i in range(self.parallels):
+            self.err_q.put('finished')
+        METRICS.gauge('error queue depth', self.err_q.qsize)
+
+        consumers = []
+        for i in range(self.parallels):
+            consumers.append(Downloader(self.h, self.err_q, self.book_dirname, self.lock,
+                                    name = 'Downloader-%d(err_links)' % (i + 1), err_links = True, 
+                                    chunk_size = self.chunk_size))
+        for i in range(self.parallels):
+            consumers[i].start()
+        for i in range(self.parallels):
+            consumers[i].join()
+        print('Error journal reparsed.')
+
+        for file, (link, error) in self.verify_Books().items(): #still corrupt once downloaded again
+            BUG_ROWS[os.path.splitext(file)[0]] = {'Link' : link, 'Error Msg.' : 'Bad file, %s' % error}
 
         # other errors manually found
         url = 'http://www.allitebooks.com/mysql-cookbook-3rd-edition/'
-        bug_item = pandas.Series(name = FORMAT_TO_FILENAME(os.path.split(url.strip('/'))[1]))
-        bug_item['Link']  = url
-        bug_item['Error Msg.'] = 'Incorrect pdf links in the page'
-        BUG_DB = BUG_DB.append(bug_item)
+        BUG_ROWS[FORMAT_TO_FILENAME(os.path.split(url.strip('/'))[1])] = {
+            'Link' : url, 'Error Msg.' : 'Incorrect pdf links in the page'}
 
+        BUG_DB = pandas.DataFrame.from_dict(BUG_ROWS, orient = 'index') #built once in bulk
+        BUG_DB.index.name = 'name'
         BUG_DB = BUG_DB.sort_values('Error Msg.')
         BUG_DB.to_excel(BUG_DBFILE)
-        DB.to_excel(DB_PATH)
-        print('All error links in BUG_FILE and fault files downloaded successfully parsed.')
-
-    def statistic_DB(self):
-        # statistics of all kinds of books
-        global DB
-        catg_counts = pandas.Series(name = 'Books Counts')
-        for idx in DB.columns:
-            if idx.startswith('CATG'):
-                catg_counts[idx.split('***')[1]] = pandas.value_counts(DB[idx]).iloc[0]
-        catg_counts.sort_values(ascending = False, inplace = True)
-
-        annual_sum = pandas.Series(name = 'Summary') # year sum
-        for i in range(DB.shape[0]):
-            year = DB.ix[i, 'Year']
-            if ',' in year: # 'January 20, 2014'
-                DB.ix[i, 'Year'] = year.split(',')[1].strip()
-            elif '-' in year: # '2014-02-24'
-                DB.ix[i, 'Year'] = year.split('-')[0].strip()
-            elif '.' in year: # '20 Jun. 2009'
-                DB.ix[i, 'Year'] = year.split('.')[1].strip()
-        year_counts = pandas.value_counts(DB['Year'])
-        for y in range(1900, 2030):
-            if str(y) in year_counts.index:
-                annual_sum[str(y)] = year_counts[str(y)]
-        temp_cats = []
-        final_cats = []
-        for idx in DB.columns:
-            if idx.startswith('CATG'):
-                temp_cats.append(idx)
-                final_cats.append(idx.split('***')[1])
-        annuals = DB.groupby('Year').count().loc[annual_sum.index, temp_cats]
-        annuals.columns = final_cats
+        CATALOG_WRITER.flush()
+        print('All error links in error journal and fault files downloaded successfully parsed.')
+
+    def export_DB(self, path = DB_PATH):
+        # export the whole catalog to a workbook, on demand only
+        global CATALOG, CATALOG_WRITER
+        CATALOG_WRITER.flush()
+        with CATALOG.lock:
+            CATALOG.export_xlsx(path)
+
+    def statistic_DB(self, path = 'counts.xlsx'):
+        # statistics of all kinds of books, from the counts kept by the catalog
+        global CATALOG, CATALOG_WRITER
+        CATALOG_WRITER.flush()
+        with CATALOG.lock:
+            catg_counts, annuals = CATALOG.stats.frames()
         # tbd. cat sum row needed, and sort the dataframe by the sum row.
-        # take care of the sum of the "annual_sum" column at last.
-        annuals = annuals.join(annual_sum)
+        with pandas.ExcelWriter(path) as writer:
+            catg_counts.to_excel(writer, sheet_name = 'categories')
+            annuals.to_excel(writer, sheet_name = 'annually summary')
 
-        writer = pandas.ExcelWriter('counts.xlsx')
-        catg_counts.to_excel(writer, sheet_name = 'categories')
-        annuals.to_excel(writer, sheet_name = 'annually summary')
-        writer.save()
+def SEARCH(args):
+    # print the books found in the catalog, best first
+    global CATALOG
+    year = args.year
+    if year and '-' in year:
+        year = tuple(year.split('-', 1))
+    started = perf_counter()
+    hits = CATALOG.search_index.search(' '.join(args.query), categories = args.category, year = year, 
+                                       limit = args.limit, raw = args.raw)
+    elapsed = perf_counter() - started
+    for hit in hits:
+        print('%6.2f  %s (%s)  [%s]' % (hit.score, hit.name, hit.year or '-', ', '.join(hit.categories)))
+        if hit.snippet:
+            print('        ' + hit.snippet.replace('\n', ' '))
+    print('%d books in %.1f ms' % (len(hits), elapsed * 1000))
+
+def SHARD_WORKER(work_queue, base_url = BASE_URL, bandwidth = BANDWIDTH):
+    # a worker process of the shard engine
+    AllITeBooksCrawler(engine = 'shard', work_queue = work_queue, base_url = base_url, 
+                       bandwidth = bandwidth).go()
+
+def SHARD_WORKERS(workers, work_queue = WORK_QUEUE_PATH, base_url = BASE_URL, bandwidth = BANDWIDTH):
+    '''crawl with worker processes on this host, more of them may be started on other hosts 
+sharing the work queue, the catalog and the books directory; then verify the books and 
+count the catalog once all are finished
+bandwidth, bytes per second of the downloads of this host, split evenly among its workers
+'''
+    global CATALOG, ERROR_JOURNAL
+    import multiprocessing
+    CATALOG.load() #a legacy workbook imported and the snapshot written once, not by every worker
+    ERROR_JOURNAL.load() #compacted before workers append to it
+    context = multiprocessing.get_context('spawn') #fresh processes, no threads or connections forked
+    share = bandwidth / workers if bandwidth else None
+    processes = [context.Process(target = SHARD_WORKER, args = (work_queue, base_url, share), 
+                                 name = 'ShardWorker-%d' % (i + 1)) for i in range(workers)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    CATALOG.store.close()
+    CATALOG.search_index.close()
+    CATALOG, ERROR_JOURNAL = Catalog(), ErrorJournal() #reloaded with the work of all workers
+    robot = AllITeBooksCrawler(base_url = base_url)
+    robot.verify_Books()
+    robot.statistic_DB()
+    CATALOG_WRITER.flush()
+    with CATALOG.lock:
+        CATALOG.snapshot()
 
 def main():
 #    return  #debug
 #    robot = AllITeBooksCrawler(updating = False) #first runing
 #    robot.go()
+    import argparse
+    parser = argparse.ArgumentParser(description = 'Crawl allitebooks.com, or search the books crawled')
+    parser.add_argument('command', nargs = '?', default = 'crawl', choices = ('crawl', 'search', 'worker', 
+                                                                          'replay'))
+    parser.add_argument('query', nargs = '*', help = 'words to search for')
+    parser.add_argument('--category', action = 'append', help = 'books in this category only, repeatable')
+    parser.add_argument('--year', help = 'books published in yyyy or yyyy-yyyy only')
+    parser.add_argument('--limit', type = int, default = SEARCH_LIMIT)
+    parser.add_argument('--raw', action = 'store_true', help = 'the query is in FTS5 syntax')
+    parser.add_argument('--workers', type = int, default = 1, help = 'worker processes to start')
+    parser.add_argument('--bandwidth', type = int, help = 'KB/s of the downloads of all workers of this host')
+    parser.add_argument('--queue', default = WORK_QUEUE_PATH, help = 'the work queue shared by workers')
+    parser.add_argument('--archive', default = ARCHIVE_PATH, 
+                        help = "the archives to replay, e.g. '*.crawl.warc.gz' of the workers")
+    args = parser.parse_args()
+    if args.command == 'search':
+        SEARCH(args)
+        return
+    if args.command == 'worker':
+        SHARD_WORKERS(args.workers, args.queue, bandwidth = args.bandwidth and args.bandwidth * 1024)
+        return
+    if args.command == 'replay':
+        AllITeBooksCrawler(replay = args.archive).go()
+        return
     robot = AllITeBooksCrawler(updating = True, start_page = None) #regular updating
     robot.go()
 
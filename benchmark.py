@@ -0,0 +1,516 @@
+# !/usr/bin/env python 3.7
+
+'''
+benchmarks of AllITeBooksCrawler, run offline against a stand-in site on localhost
+
+usage: python benchmark.py [slug] [parser] [catalog] [crawl] [options]
+       python benchmark.py crawl --books 200 --size 512 --latency 20 --errors 0.05 --resets 0.02
+       python benchmark.py crawl --spread 8 --bandwidth 4096 --policy discovery
+'''
+
+import os
+import io
+import sys
+import json
+import random
+import string
+import socket
+import struct
+import zipfile
+import argparse
+import tempfile
+import threading
+import contextlib
+import http.server
+import urllib.parse
+from time import time, perf_counter, process_time, sleep
+
+try:
+    import resource # peak RSS, not available on Windows
+except ImportError:
+    resource = None
+
+import AllITeBooksCrawler as crawler
+
+def REFERENCE_FORMAT_TO_LINK(s):
+    # the original FORMAT_TO_LINK, kept as the reference of FORMAT_NAME(s, 'link')
+    for char in s:
+        if (char in string.punctuation) or (char in string.whitespace):
+            s = s.replace(char, '-')
+        for i in range(len(s)):
+            if s[i : i + 2] == '--':
+                s = s[ : i + 1] + s[i + 2 : ]
+    return s.lower()
+
+def TIMED(func, items, repeat = 3):
+    # best wall time of calling func on all items
+    best = None
+    for i in range(repeat):
+        started = perf_counter()
+        for item in items:
+            func(item)
+        elapsed = perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+CATEGORIES = ('Programming', 'Web Development', 'Databases', 'Networking', 'Security', 
+              'Operating Systems', 'Graphics & Design', 'Software Engineering')
+
+class FakeSite(object):
+    '''a synthetic allitebooks-like site: listing pages /page/<n>/ with rel="bookmark" anchors 
+and pagination links, book pages /<slug>/ with dt/dd metadata, a description and 
+target="_blank" links to /files/<Book Name>.pdf / .epub
+books, number of books, per_page, books per listing page
+size, bytes of each file, spread, sizes vary from size / spread to size * spread if above 1
+epub, fraction of books with an ePub as well
+latency, seconds before each response
+errors, fraction of requests answered with HTTP 500
+resets, fraction of file downloads reset half way through the body
+'''
+    def __init__(self, books = 100, per_page = 10, size = 256 * 1024, epub = 0.3, latency = 0.0, 
+                 errors = 0.0, resets = 0.0, seed = 2019, spread = 1.0):
+        self.books = books
+        self.per_page = per_page
+        self.size = size
+        self.latency = latency
+        self.errors = errors
+        self.resets = resets
+        self.random = random.Random(seed)
+        self.lock = threading.Lock() # self.random is shared by handler threads
+        self.titles = ['Synthetic Book %d Vol %d' % (i, i % 7) for i in range(1, books + 1)]
+        self.slugs = {crawler.FORMAT_TO_LINK(title) : i for i, title in enumerate(self.titles)}
+        self.has_epub = [self.random.random() < epub for i in range(books)]
+        self.sizes = [int(size * spread ** self.random.uniform(-1, 1)) for i in range(books)]
+        self.files = {} # (book, ext) -> body, made on the first request
+        self.base = 'http://127.0.0.1:8000' # the real one once started
+        self.server = None
+
+    @property
+    def pages(self):
+        return (self.books + self.per_page - 1) // self.per_page
+
+    def __pdf__(self, size, i = 0):
+        # a well-formed PDF of about size bytes, passing VERIFY_PDF, of its own content per book i
+        head = b'%PDF-1.4\n1 0 obj\n<< /Length 0 >>\nstream\n'
+        body = b'%%%d ' % i + b'x' * max(size - 200, 0) + b'\nendstream\nendobj\n'
+        xref = len(head) + len(body)
+        return head + body + (b'xref\n0 2\n0000000000 65535 f \ntrailer\n<< /Size 2 >>\n'
+                              b'startxref\n%d\n%%%%EOF\n' % xref)
+
+    def __epub__(self, size):
+        # a well-formed ePub of about size bytes, passing VERIFY_EPUB
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, 'w') as book:
+            book.writestr('mimetype', 'application/epub+zip', compress_type = zipfile.ZIP_STORED)
+            book.writestr('META-INF/container.xml', '<?xml version="1.0"?><container/>')
+            book.writestr('OEBPS/content.bin', os.urandom(max(size - 300, 0)))
+        return buffer.getvalue()
+
+    def file(self, i, ext):
+        with self.lock:
+            if (i, ext) not in self.files:
+                self.files[i, ext] = self.__pdf__(self.sizes[i], i) if ext == '.pdf' else self.__epub__(self.sizes[i])
+            return self.files[i, ext]
+
+    def slug(self, i):
+        return crawler.FORMAT_TO_LINK(self.titles[i])
+
+    def listing_html(self, page):
+        first = (page - 1) * self.per_page
+        articles = ''.join('<article><h2><a href="%s/%s/" rel="bookmark">%s</a></h2></article>\n' 
+                           % (self.base, self.slug(i), self.titles[i]) 
+                           for i in range(first, min(first + self.per_page, self.books)))
+        pagination = ''.join('<a class="page-numbers" href="%s/page/%d/">%d</a>' % (self.base, n, n) 
+                             for n in sorted({1, max(page - 1, 1), page, min(page + 1, self.pages), self.pages}))
+        return ('<html><body><main>%s</main><div class="pagination"><span>%d / %d Pages</span>%s</div>'
+                '</body></html>' % (articles, page, self.pages, pagination))
+
+    def book_html(self, i):
+        title = self.titles[i]
+        links = ['<a href="%s/files/%s.pdf" target="_blank">Download PDF</a>' % (self.base, title)]
+        if self.has_epub[i]:
+            links.append('<a href="%s/files/%s.epub" target="_blank">Download ePub</a>' % (self.base, title))
+        return '''<html><body><h1>{title}</h1>
+<div class="book-detail"><dl>
+<dt>Author:</dt><dd><a href="/author/a-{i}/">Author {i}</a></dd>
+<dt>ISBN-10:</dt><dd>{isbn}</dd>
+<dt>Year:</dt><dd>{year}</dd>
+<dt>Pages:</dt><dd>{pages}</dd>
+<dt>Language:</dt><dd>English</dd>
+<dt>File size:</dt><dd>{mb:.1f} MB</dd>
+<dt>File format:</dt><dd>{formats}</dd>
+<dt>Category:</dt><dd><a href="/cat/">{catg1}</a></dd><dd><a href="/cat/">{catg2}</a></dd>
+</dl></div>
+<div class="entry-content"><h3>Book Description:</h3>
+<p>{title} is a synthetic book of the benchmark site.</p><p>{words}</p></div>
+<span class="download-links">{links}</span>
+</body></html>'''.format(title = title, i = i, isbn = 1000000000 + i, year = 2000 + i % 20, 
+                         pages = 100 + i % 900, mb = self.sizes[i] / 2 ** 20, 
+                         formats = 'PDF, ePub' if self.has_epub[i] else 'PDF', 
+                         catg1 = CATEGORIES[i % len(CATEGORIES)], 
+                         catg2 = CATEGORIES[(i * 3) % len(CATEGORIES)], 
+                         words = ' '.join(['lorem ipsum dolor sit amet'] * 40), links = ''.join(links))
+
+    def chance(self, rate):
+        with self.lock:
+            return self.random.random() < rate
+
+    def start(self):
+        handler = type('Handler', (FakeSiteHandler, ), {'site' : self})
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        self.server.daemon_threads = True
+        self.base = 'http://127.0.0.1:%d' % self.server.server_address[1]
+        threading.Thread(target = self.server.serve_forever, daemon = True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+class FakeSiteHandler(http.server.BaseHTTPRequestHandler):
+    # serves FakeSite pages and files, with Range requests for resumed downloads
+    protocol_version = 'HTTP/1.1' # keep-alive, as the crawler pools connections
+    site = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def __send__(self, status, body, headers = None):
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        site = self.site
+        if site.latency:
+            sleep(site.latency)
+        if site.errors and site.chance(site.errors):
+            return self.__send__(500, b'Internal Server Error')
+        parts = [part for part in urllib.parse.unquote(urllib.parse.urlsplit(self.path).path).split('/') 
+                 if part]
+        if len(parts) == 2 and parts[0] == 'page' and parts[1].isdigit():
+            if 1 <= int(parts[1]) <= site.pages:
+                return self.__send__(200, site.listing_html(int(parts[1])).encode('utf-8'))
+        elif len(parts) == 2 and parts[0] == 'files':
+            name, ext = os.path.splitext(parts[1])
+            if crawler.FORMAT_TO_LINK(name) in site.slugs and ext in ('.pdf', '.epub'):
+                return self.__file__(site.file(site.slugs[crawler.FORMAT_TO_LINK(name)], ext), parts[1])
+        elif len(parts) == 1 and parts[0] in site.slugs:
+            return self.__send__(200, site.book_html(site.slugs[parts[0]]).encode('utf-8'))
+        self.__send__(404, b'Not Found')
+
+    def __file__(self, body, file):
+        etag = '"%s-%d"' % (crawler.FORMAT_TO_LINK(file), len(body))
+        start = 0
+        ranges = self.headers.get('Range', '')
+        if ranges.startswith('bytes=') and self.headers.get('If-Range', etag) == etag:
+            start = int(ranges[6 : ].split('-')[0] or 0)
+        if start >= len(body):
+            return self.__send__(416, b'', {'Content-Range' : 'bytes */%d' % len(body)})
+        self.send_response(206 if start else 200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(len(body) - start))
+        self.send_header('ETag', etag)
+        if start:
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, len(body) - 1, len(body)))
+        self.end_headers()
+        if self.site.resets and self.site.chance(self.site.resets):
+            # half of the body, then a TCP reset
+            self.wfile.write(body[start : start + (len(body) - start) // 2])
+            self.wfile.flush()
+            self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+            self.close_connection = True
+            return
+        self.wfile.write(body[start : ])
+
+FAST_BUDGETS = {kind : {'rate' : 1000.0, 'min' : 10.0, 'max' : 1000.0, 'burst' : 100} 
+                for kind in ('listing', 'bookpage', 'file')} # no pacing against localhost
+
+@contextlib.contextmanager
+def SANDBOX():
+    # a temporary working directory, with fresh module-level state of the crawler
+    cwd = os.getcwd()
+    saved = crawler.CATALOG, crawler.ERROR_JOURNAL, crawler.BLOB_STORE, crawler.PAGE_CACHE, crawler.ARCHIVE
+    with tempfile.TemporaryDirectory(prefix = 'allitebooks-bench-') as dirname:
+        os.chdir(dirname)
+        crawler.CATALOG = crawler.Catalog()
+        crawler.ERROR_JOURNAL = crawler.ErrorJournal()
+        crawler.BLOB_STORE = crawler.BlobStore()
+        crawler.PAGE_CACHE = crawler.PageCache()
+        crawler.ARCHIVE = crawler.CrawlArchive()
+        crawler.DOWNLOADED_COUNT, crawler.ERROR_COUNT = crawler.AtomicCounter(), crawler.AtomicCounter()
+        crawler.LinkProducer.link_count = crawler.AtomicCounter()
+        crawler.BUG_ROWS.clear()
+        try:
+            yield dirname
+        finally:
+            if crawler.CATALOG_WRITER.is_alive(): #nothing left queued for this catalog
+                crawler.CATALOG_WRITER.flush()
+            if 'store' in crawler.CATALOG.__dict__ and hasattr(crawler.CATALOG.store, 'close'):
+                crawler.CATALOG.store.close()
+            crawler.CATALOG.search_index.close()
+            crawler.ARCHIVE.close()
+            crawler.CATALOG, crawler.ERROR_JOURNAL, crawler.BLOB_STORE, crawler.PAGE_CACHE, \
+                crawler.ARCHIVE = saved
+            os.chdir(cwd)
+
+def PEAK_RSS():
+    # peak resident set size in MB, of this process or of its largest finished child
+    if resource is None:
+        return None
+    scale = 2 ** 20 if sys.platform == 'darwin' else 2 ** 10 # bytes on macOS, KB elsewhere
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, 
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / scale
+
+def CHILDREN_CPU():
+    # CPU seconds of finished child processes, e.g. the verification pool
+    if resource is None:
+        return 0.0
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+def PARSED_BOOKS(site):
+    # secondParser results of all book pages of a site
+    parsed = []
+    for i in range(site.books):
+        parser_2 = crawler.secondParser('%s/%s/' % (site.base, site.slug(i)))
+        parser_2.feed(site.book_html(i))
+        parser_2.close()
+        parsed.append(parser_2)
+    return parsed
+
+def bench_slug(options):
+    # equivalence over all names in the catalog, and timings of FORMAT_TO_LINK
+    names = [str(name) for name in crawler.CATALOG.db.index]
+    if 'link-bookpage' in crawler.CATALOG.db.columns:
+        names += [str(link) for link in crawler.CATALOG.db['link-bookpage'].dropna()]
+    mismatches = [name for name in names 
+                  if crawler.FORMAT_NAME.__wrapped__(name, 'link') != REFERENCE_FORMAT_TO_LINK(name)]
+    print('slug: %d names, %d mismatches%s' % (len(names), len(mismatches), 
+          (' e.g. %r' % mismatches[0]) if mismatches else ''))
+    if not names:
+        return True
+    reference = TIMED(REFERENCE_FORMAT_TO_LINK, names, repeat = 1)
+    uncached = TIMED(lambda name : crawler.FORMAT_NAME.__wrapped__(name, 'link'), names)
+    crawler.FORMAT_NAME.cache_clear()
+    cached = TIMED(crawler.FORMAT_TO_LINK, names)
+    for label, elapsed in (('reference', reference), ('single pass', uncached), ('cached', cached)):
+        print('  %-12s %8.1f us/name' % (label, elapsed / len(names) * 1e6))
+    return not mismatches
+
+def bench_parser(options):
+    # firstParser / secondParser alone, over pages of the stand-in site
+    site = FakeSite(books = options.books, size = 0)
+    listings = [site.listing_html(page) for page in range(1, site.pages + 1)]
+    books = [('%s/%s/' % (site.base, site.slug(i)), site.book_html(i)) for i in range(site.books)]
+    def parse_listing(content):
+        parser_1 = crawler.firstParser()
+        parser_1.feed(content)
+        parser_1.close()
+        return parser_1.anchorlist
+    def parse_book(item):
+        parser_2 = crawler.secondParser(item[0])
+        parser_2.feed(item[1])
+        parser_2.close()
+        return parser_2
+    ok = sum(len(parse_listing(content)) for content in listings) == site.books and \
+         all(parser_2.data.anchors and parser_2.data.name for parser_2 in PARSED_BOOKS(site))
+    listing = TIMED(parse_listing, listings)
+    book = TIMED(parse_book, books)
+    print('parser: %d listing pages, %d book pages%s' % (len(listings), len(books), 
+                                                         '' if ok else ', WRONG RESULTS'))
+    for label, elapsed, n in (('listing', listing, len(listings)), ('book', book, len(books))):
+        print('  %-12s %8.1f us/page %8.0f pages/s' % (label, elapsed / n * 1e6, n / elapsed))
+    return ok
+
+def bench_catalog(options):
+    # Catalog.add of parsed book pages, then flushing new and updated rows to the store
+    parsed = PARSED_BOOKS(FakeSite(books = options.books, size = 0))
+    with SANDBOX():
+        catalog = crawler.CATALOG
+        catalog.load()
+        started = perf_counter()
+        for parser_2 in parsed:
+            catalog.add(parser_2.data.name, parser_2.data.to_dict(), parser_2.data.categories)
+        added = perf_counter() - started
+        started = perf_counter()
+        catalog.flush()
+        flushed = perf_counter() - started
+        updates = list(catalog.db.index[ : : 10])
+        started = perf_counter()
+        for name in updates:
+            catalog.mark_downloaded(name, 'pdf')
+        catalog.flush()
+        updated = perf_counter() - started
+        rows = len(catalog.db)
+        ok = rows == len(parsed) and len(crawler.Catalog().db) == rows #read back from the store
+    print('catalog: %d rows%s' % (rows, '' if ok else ', WRONG RESULTS'))
+    for label, elapsed, n in (('add', added, rows), ('flush', flushed, rows), ('update', updated, len(updates))):
+        print('  %-12s %8.1f us/row  (%d rows)' % (label, elapsed / max(n, 1) * 1e6, n))
+    return ok
+
+def bench_crawl(options):
+    # AllITeBooksCrawler.go() end to end against the stand-in site
+    site = FakeSite(books = options.books, size = options.size * 1024, latency = options.latency / 1000, 
+                    errors = options.errors, resets = options.resets, spread = options.spread).start()
+    backoff = crawler.RATE_LIMITER.base, crawler.RATE_LIMITER.cap
+    crawler.RATE_LIMITER.base, crawler.RATE_LIMITER.cap = 0.01, 0.5 # retry soon against localhost
+    try:
+        with SANDBOX():
+            robot = crawler.AllITeBooksCrawler(updating = False, engine = options.engine, 
+                                               base_url = site.base, rate_budgets = FAST_BUDGETS, 
+                                               download_policy = options.policy.split(','), 
+                                               bandwidth = options.bandwidth * 1024 or None)
+            started = time()
+            wall, cpu, children = perf_counter(), process_time(), CHILDREN_CPU()
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                robot.go()
+            wall = perf_counter() - wall
+            cpu = process_time() - cpu + CHILDREN_CPU() - children
+            snapshot = crawler.METRICS.snapshot()
+            books = len(crawler.CATALOG.db)
+            files = [file for file in os.listdir(robot.book_dirname) if not file.startswith('.')]
+            finished = sorted(os.path.getmtime(os.path.join(robot.book_dirname, file)) - started 
+                              for file in files) # when each file was completed
+    finally:
+        crawler.RATE_LIMITER.base, crawler.RATE_LIMITER.cap = backoff
+        site.stop()
+    expected = site.books + sum(site.has_epub)
+    downloaded = sum(counter['value'] for counter in snapshot['counters'] 
+                     if counter['name'] == 'bytes downloaded')
+    retries = sum(counter['value'] for counter in snapshot['counters'] if counter['name'] == 'retries')
+    rss = PEAK_RSS()
+    ok = books == site.books and len(files) == expected
+    print('crawl (%s): %d books, %d/%d files in %.2f s%s' % (options.engine, books, len(files), expected, 
+                                                             wall, '' if ok else ', INCOMPLETE'))
+    if finished:
+        print('  half of the files in %.2f s, 90%% in %.2f s (policy %s)' 
+              % (finished[len(finished) // 2], finished[len(finished) * 9 // 10], options.policy))
+    print('  %8.1f books/s %8.2f MB/s %8.2f CPU s %8s MB peak RSS %6d retries' 
+          % (books / wall, downloaded / 2 ** 20 / wall, cpu, '%.0f' % rss if rss else 'n/a', retries))
+    for stage, h in sorted(snapshot['stages'].items()):
+        print('  %-16s %6d x %8.4f s mean %8.4f s p95' % (stage, h['count'], h['mean'], h['p95']))
+    if options.json:
+        with open(options.json, 'wt') as f:
+            json.dump({'books' : books, 'files' : len(files), 'seconds' : wall, 'cpu' : cpu, 
+                       'books/s' : books / wall, 'MB/s' : downloaded / 2 ** 20 / wall, 
+                       'peak RSS MB' : rss, 'metrics' : snapshot}, f, indent = 1)
+    return ok
+
+def DOWNLOAD_STATE(db):
+    # the columns of a catalog set by downloading, as compared after reparsing
+    return db[[column for column in db.columns if column.startswith(crawler.DOWNLOAD_COLUMNS)]] \
+        .astype(object).sort_index().sort_index(axis = 1)
+
+def bench_offline(options):
+    # a crawl reparsed offline from its page cache, which keeps what was downloaded
+    site = FakeSite(books = options.books, size = 1024).start()
+    with SANDBOX():
+        try:
+            robot = crawler.AllITeBooksCrawler(updating = False, base_url = site.base, 
+                                               rate_budgets = FAST_BUDGETS)
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                robot.go()
+        finally:
+            site.stop()
+        crawled = DOWNLOAD_STATE(crawler.CATALOG.db)
+        robot = crawler.AllITeBooksCrawler(updating = False, base_url = site.base, offline = True)
+        wall = perf_counter()
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            robot.go()
+        wall = perf_counter() - wall
+        reparsed = crawler.METRICS.snapshot()['stages'].get('bookpage fetch', {}).get('count', 0)
+        kept = DOWNLOAD_STATE(crawler.CATALOG.db)
+        stored = DOWNLOAD_STATE(crawler.CATALOG.store.load()[0]) #read back from the store, not the snapshot
+    downloaded = int(kept['downloaded (PDF)?'].sum())
+    ok = reparsed == site.books and downloaded == site.books and crawled.equals(kept) and \
+         crawled.equals(stored)
+    print('offline: %d book pages reparsed in %.2f s, %d/%d still downloaded%s' 
+          % (reparsed, wall, downloaded, site.books, '' if ok else ', WRONG RESULTS'))
+    return ok
+
+def PARSED_ROWS():
+    # the catalog as parsed from book pages, without what downloading adds to it
+    db = crawler.CATALOG.db
+    return db[[column for column in db.columns 
+               if not column.startswith(('downloaded', 'bytes', 'sha256', 'verified'))]].sort_index()
+
+def bench_replay(options):
+    # a crawl archived, then replayed from the archive and reparsed from it with the site gone
+    site = FakeSite(books = options.books, size = 1024, latency = options.latency / 1000).start()
+    timings = []
+    with SANDBOX() as dirname:
+        try:
+            robot = crawler.AllITeBooksCrawler(updating = False, base_url = site.base, 
+                                               rate_budgets = FAST_BUDGETS)
+            wall = perf_counter()
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                robot.go()
+            timings.append(('live crawl', perf_counter() - wall))
+            live = PARSED_ROWS()
+            crawled = DOWNLOAD_STATE(crawler.CATALOG.db)
+        finally:
+            site.stop()
+        archive = os.path.join(dirname, crawler.ARCHIVE_PATH)
+        size = os.path.getsize(archive)
+        with SANDBOX():
+            robot = crawler.AllITeBooksCrawler(updating = False, base_url = site.base, replay = archive)
+            wall = perf_counter()
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                robot.go()
+            timings.append(('replay', perf_counter() - wall))
+            replayed = PARSED_ROWS()
+        with SANDBOX():
+            robot = crawler.AllITeBooksCrawler(base_url = site.base)
+            wall = perf_counter()
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                robot.reparse_Archive(archive, processes = 0)
+            timings.append(('reparse', perf_counter() - wall))
+            reparsed = PARSED_ROWS()
+        robot = crawler.AllITeBooksCrawler(updating = False, base_url = site.base, replay = archive)
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            robot.go() #over the catalog crawled, which keeps what was downloaded
+            robot.reparse_Archive(archive, processes = 0)
+        kept = DOWNLOAD_STATE(crawler.CATALOG.db)
+        stored = DOWNLOAD_STATE(crawler.CATALOG.store.load()[0])
+    downloaded = int(kept['downloaded (PDF)?'].sum())
+    ok = len(live) == site.books and live.equals(replayed) and live.equals(reparsed) and \
+         downloaded == site.books and crawled.equals(kept) and crawled.equals(stored)
+    print('replay: %d books, archive %.1f KB, %d/%d still downloaded after replaying in place%s' 
+          % (len(live), size / 1024, downloaded, site.books, '' if ok else ', WRONG RESULTS'))
+    for label, elapsed in timings:
+        print('  %-12s %8.2f s %8.1f books/s' % (label, elapsed, len(live) / elapsed))
+    return ok
+
+BENCHMARKS = {'slug' : bench_slug, 'parser' : bench_parser, 'catalog' : bench_catalog, 
+              'crawl' : bench_crawl, 'offline' : bench_offline, 'replay' : bench_replay}
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'benchmarks of AllITeBooksCrawler')
+    parser.add_argument('names', nargs = '*', help = 'of %s, all by default' % ', '.join(BENCHMARKS))
+    parser.add_argument('--books', type = int, default = 100, help = 'books of the stand-in site')
+    parser.add_argument('--size', type = int, default = 256, help = 'KB per file')
+    parser.add_argument('--latency', type = float, default = 0, help = 'ms before each response')
+    parser.add_argument('--errors', type = float, default = 0, help = 'fraction of HTTP 500 responses')
+    parser.add_argument('--resets', type = float, default = 0, help = 'fraction of downloads reset')
+    parser.add_argument('--spread', type = float, default = 1, help = 'file sizes vary by this factor')
+    parser.add_argument('--engine', choices = crawler.ENGINES, default = 'threads')
+    parser.add_argument('--policy', default = ','.join(crawler.DOWNLOAD_POLICY), 
+                        help = 'download policies, of %s' % ', '.join(crawler.DOWNLOAD_POLICIES))
+    parser.add_argument('--bandwidth', type = int, default = 0, help = 'KB/s of all downloads, 0 for no limit')
+    parser.add_argument('--json', help = 'write the crawl results to this file')
+    options = parser.parse_args(argv)
+    unknown = [name for name in options.names if name not in BENCHMARKS]
+    if unknown:
+        parser.error('unknown benchmarks: %s' % ', '.join(unknown))
+    ok = True
+    for name in options.names or list(BENCHMARKS):
+        ok = BENCHMARKS[name](options) and ok
+    return 0 if ok else 1
+
+if __name__ == '__main__':
+    raise SystemExit(main())